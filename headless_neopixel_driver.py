@@ -0,0 +1,179 @@
+#
+
+"""
+
+Headless stand-in for fencepost_neopixel_driver.
+
+Implements the same module level interface (geometry and color constants,
+set_all_pixels, get_all_pixels, copy_all_pixels, set_intensity, wheel) plus
+copy_buffer, copy_buffer_spans, copy_string_buffer, end_frame and
+copy_encoded_frame, without any LED strings attached, so the lighting code can
+run and be measured on a plain Linux box.
+
+Optionally
+    - records every frame written, with a time stamp, to a binary file
+      (for copy_string_buffer, when end_frame is called)
+    - sleeps for the time the real strings would take to shift the frame out
+
+Select it in rl.py with the environment variable
+    RL_NEOPIXEL_DRIVER=headless_neopixel_driver
+
+Recording file format, little endian:
+    header  "RLFR" magic, u16 version, u32 pixels per frame
+    frame   f64 time.monotonic() time stamp, u32 length in bytes, r,g,b bytes
+
+"""
+
+import struct
+import time
+
+import rl_frame_codec
+
+
+COLOR_OFF   = (0, 0, 0)
+COLOR_RED   = (255, 0, 0)
+COLOR_GREEN = (0, 255, 0)
+COLOR_BLUE  = (0, 0, 255)
+COLOR_WHITE = (255, 255, 255)
+
+INTENSITY_OFF    = 0.0
+INTENSITY_LOW    = 0.1
+INTENSITY_MEDIUM = 0.4
+INTENSITY_HIGH   = 1.0
+
+N_LEDS_PER_POST   = 4
+N_LEDS_PER_STRING = [200]
+
+# WS2812 timing
+WIRE_BIT_TIME   = 1.25e-6       # 800 kHz
+WIRE_RESET_TIME = 50e-6         # latch
+WIRE_PARALLEL   = True          # strings are on separate data lines and shift out together
+
+RECORD_MAGIC   = b"RLFR"
+RECORD_VERSION = 1
+RECORD_HEADER  = struct.Struct("<4sHI")
+RECORD_FRAME   = struct.Struct("<dI")
+
+emulate_wire_time = False
+frames_written    = 0
+_pixels           = bytearray(3 * sum(N_LEDS_PER_STRING))
+_record_file      = None
+
+
+def configure(leds_per_string=None, leds_per_post=None, wire_time=None):
+    '''Change the emulated geometry and/or turn wire time emulation on or off. Clears all pixels.'''
+    global N_LEDS_PER_STRING, N_LEDS_PER_POST, emulate_wire_time, _pixels
+    if leds_per_string is not None:
+        N_LEDS_PER_STRING = list(leds_per_string)
+    if leds_per_post is not None:
+        N_LEDS_PER_POST = leds_per_post
+    if wire_time is not None:
+        emulate_wire_time = wire_time
+    _pixels = bytearray(3 * sum(N_LEDS_PER_STRING))
+
+def wire_time(string=None):
+    '''Seconds the real strings (or one string) take to shift out one frame.'''
+    if string is not None:
+        n_leds = N_LEDS_PER_STRING[string]
+    elif WIRE_PARALLEL:
+        n_leds = max(N_LEDS_PER_STRING)
+    else:
+        n_leds = sum(N_LEDS_PER_STRING)
+    return 24 * WIRE_BIT_TIME * n_leds + WIRE_RESET_TIME
+
+def start_recording(path):
+    global _record_file
+    stop_recording()
+    _record_file = open(path, "wb")
+    _record_file.write(RECORD_HEADER.pack(RECORD_MAGIC, RECORD_VERSION, len(_pixels) // 3))
+
+def stop_recording():
+    global _record_file
+    f, _record_file = _record_file, None    # stop _show() writing before closing
+    if f is not None:
+        f.close()
+
+def read_recording(path):
+    '''Generator of (time stamp, frame bytes) from a recording file.'''
+    with open(path, "rb") as f:
+        magic, version, n_pixels = RECORD_HEADER.unpack(f.read(RECORD_HEADER.size))
+        if magic != RECORD_MAGIC or version != RECORD_VERSION:
+            raise ValueError("%s is not a version %d frame recording" % (path, RECORD_VERSION))
+        while True:
+            head = f.read(RECORD_FRAME.size)
+            if len(head) < RECORD_FRAME.size:
+                return
+            t, length = RECORD_FRAME.unpack(head)
+            yield t, f.read(length)
+
+def _record():
+    '''Count and optionally record a complete frame.'''
+    global frames_written
+    frames_written += 1
+    f = _record_file
+    if f is not None:
+        f.write(RECORD_FRAME.pack(time.monotonic(), len(_pixels)))
+        f.write(_pixels)
+
+def _show():
+    '''Write _pixels to the (emulated) strings.'''
+    _record()
+    if emulate_wire_time:
+        time.sleep(wire_time())
+
+def set_intensity(color, intensity):
+    '''Scale (r, g, b) color by intensity 0.0 - 1.0.'''
+    return tuple(int(round(c * intensity)) for c in color)
+
+def wheel(pos):
+    '''Color wheel, pos 0 - 255 goes red -> green -> blue -> red.'''
+    pos = pos & 0xff
+    if pos < 85:
+        return (255 - pos * 3, pos * 3, 0)
+    if pos < 170:
+        pos -= 85
+        return (0, 255 - pos * 3, pos * 3)
+    pos -= 170
+    return (pos * 3, 0, 255 - pos * 3)
+
+def set_all_pixels(color, intensity):
+    _pixels[:] = bytes(set_intensity(color, intensity)) * (len(_pixels) // 3)
+    _show()
+
+def get_all_pixels():
+    '''List of (r, g, b) tuples, one per pixel.'''
+    b = bytes(_pixels)
+    return list(zip(b[0::3], b[1::3], b[2::3]))
+
+def copy_all_pixels(pixel_list):
+    _pixels[:] = bytes(c for pixel in pixel_list for c in pixel)
+    _show()
+
+def copy_buffer(buf):
+    '''Write a frame from any bytes-like object of r, g, b bytes, 3 per pixel.'''
+    _pixels[:] = buf
+    _show()
+
+def copy_encoded_frame(data):
+    '''Write a frame encoded by rl_frame_codec.encodeFrame(), decoded the way a DM decodes it.'''
+    rl_frame_codec.decodeFrame(data, _pixels)
+    _record()
+    if emulate_wire_time:
+        time.sleep(8 * WIRE_BIT_TIME * len(data) + WIRE_RESET_TIME)
+
+def copy_buffer_spans(buf, spans):
+    '''Write only the (start, stop) pixel spans of a whole frame of r, g, b bytes, the rest of the pixels are unchanged.'''
+    for start, stop in spans:
+        _pixels[3*start:3*stop] = buf[3*start:3*stop]
+    _show()
+
+def copy_string_buffer(string, buf):
+    '''Write one string from any bytes-like object of r, g, b bytes. Safe to call for different strings from different threads.'''
+    start = 3 * sum(N_LEDS_PER_STRING[:string])
+    _pixels[start:start+len(buf)] = buf
+    if emulate_wire_time:
+        time.sleep(wire_time(string))
+
+def end_frame():
+    '''Call once the strings of a frame have been written with copy_string_buffer.'''
+    _record()
@@ -20,23 +20,31 @@ lights on and off in response.
 import adafruit_bus_device.spi_device
 import board
 import busio
-import fencepost_neopixel_driver as npdrvr
+import importlib
+import json
 import logging
 import logging.handlers # separate module from logging
 import os
-import pickle
 import queue
-import random
 import requests
+import rl_net
 import RPi.GPIO as gpio
 import socket
 import threading
 import time
 import glob
 
+# LED string driver, a module with the fencepost_neopixel_driver interface
+# RL_NEOPIXEL_DRIVER=headless_neopixel_driver runs the lighting without strings attached
+NEOPIXEL_DRIVER = os.environ.get("RL_NEOPIXEL_DRIVER", "fencepost_neopixel_driver")
+npdrvr = importlib.import_module(NEOPIXEL_DRIVER)
+
+from rl_lighting import FrameScheduler, FencepostRenderer, PostGeometry, Palette, PowerBudget
+
 
 CONFIGURATION_FILE = "rooftop_lighting_config.json"
 ROOFTOP_LIGHTING_PORT = 7663        # 'roof' on telephone keypad
+ROOFTOP_MULTICAST_GROUP = "239.255.76.63"   # roof-wide lighting commands, UDP on ROOFTOP_LIGHTING_PORT
 SYSTEM_HOSTS = ("roof_cm", "roof_dm")
 
 # log files running as a linux service require an absolute path
@@ -57,11 +65,15 @@ class tempThread(threading.Thread):
         self.temp_outdoor   = 0.0
         self.temp_discharge = 0.0
         healthThread.registerCallback(self._jsonReport)
+        serverThread.registerHandler("TEMP_QUERY", self._tempQuery)
 
     def _jsonReport(self):
         temp = dict(temp=dict(indoor=self.temp_indoor, outdoor=self.temp_outdoor, discharge=self.temp_discharge))
         return temp
 
+    def _tempQuery(self, msg, reply):
+        reply((self.temp_indoor, self.temp_outdoor, self.temp_discharge))
+
     def _readTempF(self, sensor):
         lines = ["empty list",]
         while lines[0].strip()[-3:] != 'YES':
@@ -99,13 +111,35 @@ class tempThread(threading.Thread):
 
 
 class viThread(threading.Thread):
+    # Other threads can be called with every (vin, cur) sample by registering
+    # a callback, e.g. the lighting thread calibrating its current model.
     SAMPLE_INTERVAL = 60    # sample voltage and current once every minute
     READ_VIN = 0xD0
     READ_CUR = 0xF0
+    CUR_FULL_SCALE = 1000   # mA at adc full scale
+    sample_callback = []
 
     def __init__(self):
         threading.Thread.__init__(self)
         self.daemon = True
+        serverThread.registerHandler("VI_QUERY", self._viQuery)
+        serverThread.registerHandler("VI_HISTORY", self._viHistory)
+
+    @staticmethod
+    def registerCallback(callback):
+        viThread.sample_callback.append(callback)
+
+    def _viQuery(self, msg, reply):
+        # fetch global variable with latest vi sample
+        with g_vi_lock:
+            (vin, cur) = g_vi_latest
+        reply((vin, cur))
+
+    def _viHistory(self, msg, reply):
+        vi_list = []
+        if not vi_q.empty():
+            vi_list.append(vi_q.get_nowait())
+        reply(vi_list)
 
     def run(self):
         global g_vi_latest
@@ -138,7 +172,7 @@ class viThread(threading.Thread):
                 spi.write_readinto(command, result)
 
             adc_value = int.from_bytes(result, byteorder='big')>>7 # bits 8-19 are valid
-            cur = (1000 * adc_value) / 4096      # adc input is 3.3V @ 1000 mA of current
+            cur = (viThread.CUR_FULL_SCALE * adc_value) / 4096      # adc input is 3.3V @ 1000 mA of current
 
             if vi_q.full(): # remove oldest item if queue full
                 try:
@@ -154,6 +188,8 @@ class viThread(threading.Thread):
             # update global variable with latest sample
             with g_vi_lock:
                 g_vi_latest = (vin, cur)
+            for callback in self.sample_callback:
+                callback(vin, cur)
 
             # add to log file
             record = time.strftime("%m/%d/%Y %H:%M")+"\t%.1f"%vin+"\t%d"%cur
@@ -163,150 +199,109 @@ class viThread(threading.Thread):
 
 
 class fpLightingThread(threading.Thread):
-    STD_COLOR     = { "RED" : npdrvr.COLOR_RED, "GREEN" : npdrvr.COLOR_GREEN, "BLUE" : npdrvr.COLOR_BLUE, "WHITE" : npdrvr.COLOR_WHITE }
-    STD_INTENSITY = { "LOW" : npdrvr.INTENSITY_LOW, "MEDIUM" : npdrvr.INTENSITY_MEDIUM, "HIGH" : npdrvr.INTENSITY_HIGH }
-    STROBE_ON_TIME      = 0.010     # 10 mS
-    STROBE_INTERVAL     = 1.0       # flash every 1 second
-    THROB_INTERVAL      = 4.0       # seconds from dark to set intensity and back to dark
-    THROB_STEPS         = 20        # num-1 (steps include 0) of discrete intensities between dark and set intensity
-    MARCH_POSTS         = 2         # MARCH pattern is 2 posts on, 2 posts off, stepping 1 post per interval
-    MARCH_INTERVAL      = 1.0       # post pattern marches every second
-    TWINKLE_INTERVAL    = 0.5       # sec
+    FRAME_RATE          = 50        # target frames per second, sets the STEADY refresh rate
+    LATE_FRAME_POLICY   = FrameScheduler.POLICY_SKIP
 
     def __init__(self):
         threading.Thread.__init__(self)
         self.daemon = True
         self.light_style = ("DISPLAY", "WHITE", "LOW", "STEADY")
-        self.delay = 1.0      # 10 ms
-        self.color = npdrvr.COLOR_WHITE
-        self.intensity = npdrvr.INTENSITY_LOW
-        self.strobe = False     # True = ON (flash), False = OFF
-        self.throb  = False     # True = increasing intensity, False = decreasing intensity
-        self.throb_step = 1     # Must be 0 < self.throb_step < THROB_STEPS
-        self.march_on   = True  # True = turn post LEDs on, False = turn post LEDs off
-        self.march_step = 0
-
-    def _colorLookup(self, color):
-        if color in self.STD_COLOR:
-            pixel_color = self.STD_COLOR[color]
-        elif color == "RAINBOW":
-            pixel_color = npdrvr.wheel(random.randint(1, 255))
-        else:
-            pixel_color = npdrvr.COLOR_WHITE
-        return pixel_color
+        self.scheduler = FrameScheduler(self.FRAME_RATE, self.LATE_FRAME_POLICY)
+        self.delay = self.scheduler.period      # seconds from this frame's deadline to the next
+        try:
+            with open(CONFIGURATION_FILE) as f:
+                config = json.load(f)
+        except FileNotFoundError:
+            config = {}
+        self.geometry = PostGeometry.fromConfig(config, npdrvr)     # (post, orientation) -> pixels
+        self.power = PowerBudget.fromConfig(config, npdrvr)     # per supply current limit
+        self.renderer = FencepostRenderer(npdrvr, self.scheduler.period, self.geometry,
+                                          Palette.fromConfig(config, FencepostRenderer.PALETTE_SIZE), self.power)
+        viThread.registerCallback(lambda vin, cur: self.power.calibrate(cur, vin, viThread.CUR_FULL_SCALE))   # measured input current calibrates the current model
+        self.batch_posts = 0                    # posts in the last LIGHTING_BATCH message
+        healthThread.registerCallback(self._jsonReport)
+        for msg_type in ("DISPLAY", "LIGHTING", "LIGHTING_BATCH", "VIDEO"):
+            serverThread.registerHandler(msg_type, self._queueCommand)
+
+    @staticmethod
+    def _queueCommand(msg, reply):
+        if msg[0] == "LIGHTING_BATCH" and isinstance(msg[1], memoryview):
+            msg = (msg[0], bytes(msg[1]))   # binary entries point into the receive buffer
+        lighting_cmd_q.put((time.monotonic(), msg))     # queue time for command latency
 
-    def _intensityLookup(self, intensity):
-        return self.STD_INTENSITY.get(intensity, npdrvr.INTENSITY_LOW)
+    def _jsonReport(self):
+        if self.light_style[0] == "LIGHTING_BATCH":     # entries can be thousands of posts or packed bytes
+            style = ["LIGHTING_BATCH", self.batch_posts]
+        else:
+            style = list(self.light_style)
+        lighting = dict(style=style, frames=self.scheduler.stats())
+        lighting.update(self.renderer.report())
+        return dict(lighting=lighting)
 
     def run(self):
         server_log.info("fpLightingThread running")
 
         # set LED string to default condition
-        npdrvr.set_all_pixels(self.color, self.intensity)
+        self.renderer.renderDisplay(self.light_style)
+        self.renderer.flush()
+        self.scheduler.resync()
 
         while True:
 
-            # sleep until display needs updating
-            # check for incoming messages, update light_style
+            # sleep until the next frame deadline or an incoming message
+            # update light_style
             # do whatever is needed to display light_style
 
-            time.sleep(self.delay)
-
-            try:
-                msg = lighting_cmd_q.get_nowait()
-                lighting_cmd_q.task_done()
+            self.scheduler.frameDone()          # previous frame rendered and written
+            msg = self.scheduler.wait(self.delay, lighting_cmd_q)   # returns early on a new command
+            if msg is not None:
                 self.light_style = msg
-            except:
-                pass
+                self.renderer.restart(msg)
 
             if self.light_style[0] == "DISPLAY" :       # message type = (DISPLAY, COLOR, INTENSITY, PATTERN)
-
-                # display color is one of (RED, GREEN, BLUE, WHITE, RAINBOW)
-                self.color = self._colorLookup(self.light_style[1])
-
-                # display intensity is one of (LOW, MEDIUM, HIGH)
-                self.intensity = self._intensityLookup(self.light_style[2])
-
-                # display pattern is one of (STEADY, STROBE, THROB, MARCH, TWINKLE)
-                if   self.light_style[3] == "STEADY":
-                    self.delay = 0.1
-                    npdrvr.set_all_pixels(self.color, self.intensity)
-
-                elif self.light_style[3] == "STROBE":
-                    if self.strobe:
-                        self.strobe = False
-                        self.intensity = npdrvr.INTENSITY_OFF
-                        self.delay = self.STROBE_INTERVAL
-                    else:
-                        self.strobe = True
-                        self.delay = self.STROBE_ON_TIME
-                    npdrvr.set_all_pixels(self.color, self.intensity)
-
-                elif self.light_style[3] == "THROB":
-                    if self.throb:                              # increasing intensity
-                        self.throb_step += 1
-                        if self.throb_step >= self.THROB_STEPS: # full intensity
-                            self.throb = False                  # now start reducing intensity
-                    else:                                       # decreasing intensity
-                        self.throb_step -= 1
-                        if self.throb_step <= 0:                # min intensity (off)
-                            self.throb = True                   # now start increasing intensity
-                    # scale intensity INTENSITY_LOW -> 1
-                    intensity = npdrvr.INTENSITY_LOW + (((self.intensity - npdrvr.INTENSITY_LOW) * self.throb_step) / self.THROB_STEPS)
-                    npdrvr.set_all_pixels(self.color, intensity)
-                    self.delay = (self.THROB_INTERVAL / 2) / (self.THROB_STEPS + 1)
-
-                elif self.light_style[3] == "MARCH":
-                    pixel_list = npdrvr.get_all_pixels()
-                    for i in reversed(range(npdrvr.N_LEDS_PER_POST, npdrvr.N_LEDS_PER_STRING[0])):  # scroll pixels one post
-                        pixel_list[i] = pixel_list[i-npdrvr.N_LEDS_PER_POST]
-
-                    npdrvr.set_all_pixels(self.color, 0.0)
-                    '''
-
-                    self.march_step += 1
-                    if self.march_step >= self.MARCH_POSTS:
-                        self.march_step = 0
-                        self.march_on = not self.march_on   # toggle on/off state of post at start of string
-                    if not self.march_on:
-                        self.intensity = npdrvr.INTENSITY_OFF
-                    for i in range(npdrvr.N_LEDS_PER_POST):
-                        pixel_list[i] = npdrvr.set_intensity(self.color, self.intensity)
-                    '''
-
-                    npdrvr.copy_all_pixels(pixel_list)
-                    self.delay = self.MARCH_INTERVAL
-
-                elif self.light_style[3] == "TWINKLE":
-                    pixel_list = npdrvr.get_all_pixels()
-                    n_pixels = len(pixel_list)
-                    for j in range(int(n_pixels/4)):     # randomly change state of 1/4 of the pixels
-                        i = random.randint(0, n_pixels-1)
-                        if pixel_list[i] == (0, 0, 0):
-                            pixel_list[i] = npdrvr.set_intensity(self.color, self.intensity)
-                        else:
-                            pixel_list[i] = (0, 0, 0)
-                    npdrvr.copy_all_pixels(pixel_list)
-                    self.delay = self.TWINKLE_INTERVAL
-
-                else:   # unrecognized pattern, reset to default
-                    self.light_style[3] = "STEADY"
-                    self.delay = 0.0
+                delay = self.renderer.renderDisplay(self.light_style)
+                if delay is None:   # unrecognized pattern, reset to default
                     server_log.warning("Unrecognized lighting pattern = %s", self.light_style[3])
+                    self.light_style = ("DISPLAY", self.light_style[1], self.light_style[2], "STEADY")
+                    self.delay = 0.0
+                else:
+                    self.delay = delay
+                    self.renderer.flush()
 
             elif self.light_style[0] == "LIGHTING":       # message type = (LIGHTING, FENCEPOST NUMBER, ORIENTATION, COLOR, BRIGHTNESS)
-                self.color = self.light_style[3]
-                self.intensity = self.light_style[4]
-                pixel_list = npdrvr.get_all_pixels()
-                i_start = pixel_index(int(int(self.light_style[1])), self.light_style[2], position=1)
-                for i in range(i_start, i_start+npdrvr.N_LEDS_PER_POST):
-                    pixel_list[i] = npdrvr.set_intensity(self.color, self.intensity)
-                npdrvr.copy_all_pixels(pixel_list)
+                try:
+                    self.renderer.renderLighting(int(self.light_style[1]), self.light_style[2], self.light_style[3], self.light_style[4])
+                except (KeyError, IndexError, ValueError, TypeError) as e:    # unknown fencepost or malformed message
+                    server_log.warning("Lighting message %r ignored, %s: %s", self.light_style, type(e).__name__, e)
+                    self.light_style = ("DISPLAY", "WHITE", "LOW", "STEADY")
+                    self.delay = 0.0
+                else:
+                    self.renderer.flush()
+
+            elif self.light_style[0] == "LIGHTING_BATCH":     # message type = (LIGHTING_BATCH, [(FENCEPOST NUMBER, ORIENTATION, COLOR, BRIGHTNESS), ...] or packLighting() bytes)
+                try:
+                    self.batch_posts = self.renderer.renderLightingBatch(self.light_style[1])
+                except (KeyError, ValueError, TypeError) as e:    # unknown fencepost or malformed entry
+                    server_log.warning("Lighting batch ignored, %s: %s", type(e).__name__, e)
+                    self.light_style = ("DISPLAY", "WHITE", "LOW", "STEADY")
+                    self.delay = 0.0
+                else:
+                    self.renderer.flush()
+
+            elif self.light_style[0] == "VIDEO":      # message type = (VIDEO, FILE, INTENSITY[, WIDTH, HEIGHT, FPS])
+                try:
+                    self.delay = self.renderer.renderVideo(self.light_style)
+                except (OSError, ValueError) as e:
+                    server_log.warning("Cannot play video %s: %s", self.light_style[1], e)
+                    self.light_style = ("DISPLAY", "WHITE", "LOW", "STEADY")
+                    self.delay = 0.0
+                else:
+                    self.renderer.flush()
 
             else:   # unrecognized type, reset to default
+                server_log.warning("Unrecognized lighting message type = %s", self.light_style[0])
                 self.light_style = ("DISPLAY", "WHITE", "LOW", "STEADY")
                 self.delay = 0.0
-                server_log.warning("Unrecognized lighting message type = %s", self.light_style[0])
 
 class healthThread(threading.Thread):
     # The health thread reports regularly a remote URL
@@ -335,11 +330,16 @@ class healthThread(threading.Thread):
         self.host_name = host
         self.node_type = node_t
         self.daemon = True
+        self.mm_client = rl_net.FramedClient("magicmirror", HOME_AUTOMATION_PORT)    # persistent, reconnects on error
+        serverThread.registerHandler("HEALTH_NOTICE", self._healthNotice)
 
     @staticmethod
     def registerCallback(callback):
         healthThread.json_callback.append(callback)
 
+    def _healthNotice(self, msg, reply):
+        mm.nodeStatusHandler(msg[1])    # pass JSON payload
+
     def run(self):
         server_log.info("healthThread running")
 
@@ -360,93 +360,113 @@ class healthThread(threading.Thread):
             # fireriser is out of magic mirror's local network
             if (self.node_type != "fireriser"):
                 msg = ("HEALTH_NOTICE", health_status)  # message must be a list
-                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
                 try:
-                    s.connect(("magicmirror", HOME_AUTOMATION_PORT))
-                except:
-                    server_log.warning("healthThread failed to report to magic mirror, socket could not be established.")
-                else:
-                    s.sendall(pickle.dumps(msg, pickle.HIGHEST_PROTOCOL))
-                    s.close()
+                    self.mm_client.send(msg)
+                except OSError:
+                    server_log.warning("healthThread failed to report to magic mirror, connection could not be established.")
 
             time.sleep(self.HEARTBEAT_INTERVAL)
 
 
 
 class serverThread(threading.Thread):
+    # Serves messages on ROOFTOP_LIGHTING_PORT. Legacy clients send one
+    # pickled message per connection and shut down their side, framed
+    # clients (rl_net.FramedClient) keep a connection open for many messages.
+    # Messages are handled concurrently on a bounded worker pool (rl_net.TCPServer),
+    # so a slow or stalled client doesn't hold up everyone else. Idle
+    # persistent connections wait in a selector and hold no worker.
+    #
+    # Subsystems register a handler(msg, reply) for each message type they
+    # serve when they are created, reply(obj) sends obj back to the client.
+    # The dispatch table is frozen when the serverThread is created, keeping
+    # only the message types of this node type.
+    MAX_CLIENTS     = 16        # connections handled at once, worker threads
+    MAX_CONNECTIONS = 64        # connections open at once, idle persistent ones included
+    READ_TIMEOUT    = 5.0       # sec per socket operation before a client is dropped
+    IDLE_TIMEOUT    = 180.0     # sec a framed connection may wait between messages
+    ALLOW_PICKLE    = True      # accept pickled messages until every client sends binary (rl_msg_codec)
+    dispatcher = rl_net.Dispatcher(logging.getLogger('rl.server'))
+
     def __init__(self, node_t):
         threading.Thread.__init__(self)
-        node_type = node_t
+        self.node_type = node_t
         self.daemon = True
+        self.server = None
+        self.dispatcher.freeze(node_t, MSG_TYPES)
+        healthThread.registerCallback(self._jsonReport)
+
+    @staticmethod
+    def registerHandler(msg_type, handler):
+        serverThread.dispatcher.register(msg_type, handler)
+
+    def _jsonReport(self):
+        server = dict(handlers=self.dispatcher.report())
+        if self.server is not None:
+            server.update(self.server.report())
+        return dict(server=server)
 
     def run(self):
         server_log.info("serverThread running")
 
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.bind(('', ROOFTOP_LIGHTING_PORT)) # listen on all IP addresses on this host
-        s.listen(5)
-        server_log.info("Listening on port (%s, %d)", "''", HOME_AUTOMATION_PORT)
+        self.server = rl_net.TCPServer(ROOFTOP_LIGHTING_PORT, self._handleClient, self.MAX_CLIENTS, self.READ_TIMEOUT, server_log,
+                                       idle_timeout=self.IDLE_TIMEOUT, max_connections=self.MAX_CONNECTIONS)
+        server_log.info("Listening on port (%s, %d)", "''", ROOFTOP_LIGHTING_PORT)
+        self.server.serveForever()
 
-        while True:
-            buf = b''
-            client, addr = s.accept()   # block until connection request
-            while True:
-                data = client.recv(4096)
-                if data:
-                    buf += data
-                if not data:
-                    # client has sent message and shut down connection
-                    break
-
-            msg = pickle.loads(buf) # depickle network message back to a message list
-            server_log.debug("Received message: %s", str(msg))
-            msg_t = msg[0]
-
-            # validate message can be handled by this node type
-            if msg_t not in MSG_TYPES:
-                server_log.warning("Unknown message type received: %s" % msg_t)
-            else:
-                if node_type not in MSG_TYPES[msg_t]:
-                    server_log.warning("Message type %s cannot be handled by this node type" % msg_t)
-
-                else:   # decode and respond to message
-                    if msg_t == "VI_QUERY":
-                        # fetch global variable with latest vi sample
-                        with g_vi_lock:
-                            (vin, cur) = g_vi_latest
-                        client.sendall(pickle.dumps((vin, cur), pickle.HIGHEST_PROTOCOL))
-
-                    elif msg_t == "SOUND":
-                        # get mp3 file and drive output
-                        pass
-
-                    elif msg_t == "VI_HISTORY":
-                        vi_list = []
-                        if not vi_q.empty():
-                            vi_list.append(vi_q.get_nowait())
-                        client.sendall(pickle.dumps(vi_list, pickle.HIGHEST_PROTOCOL))
-
-                    elif msg_t == "DISPLAY":
-                        lighting_cmd_q.put(msg)
-
-                    elif msg_t == "FLOW_QUERY":
-                        # client.sendall() included in lock in case gal, etc are references to flow_t variables
-                        with g_flow_lock:
-                            gal  = flow_t.flowGal()
-                            gpm  = flow_t.flowGPM()
-                            zone = flow_t.flowZone()
-                            client.sendall(pickle.dumps((gpm, gal, zone), pickle.HIGHEST_PROTOCOL))
-
-                    elif msg_t == "FLOW_HISTORY":
-                        with open('flowrecord.txt', 'r') as f:
-                            history = f.readlines()
-                            client.sendall(pickle.dumps(history.reverse(), pickle.HIGHEST_PROTOCOL))
-
-                    elif msg_t == "HEALTH_NOTICE":
-                        mm.nodeStatusHandler(msg[1])    # pass JSON payload
-                        pass
-
-            client.close()
+    def _handleClient(self, client, addr):
+        '''Serve one connection, legacy or framed. Runs on a worker thread, TCPServer parks or closes the client.'''
+        return rl_net.serveConnection(client, self._handleMessage, self.ALLOW_PICKLE)
+
+    def _handleMessage(self, msg, reply):
+        server_log.debug("Received message: %s", msg)
+        self.dispatcher.dispatch(msg, reply)
+
+
+class multicastThread(threading.Thread):
+    # Receives roof-wide lighting commands sent to ROOFTOP_MULTICAST_GROUP
+    # (rl_net.MulticastSender), so one datagram changes the scene on every
+    # node at the same moment instead of one TCP connection per node in turn.
+    # Messages go through the serverThread dispatch table, queries and
+    # anything else needing a reply stay on TCP.
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.listener = None
+        healthThread.registerCallback(self._jsonReport)
+
+    def _jsonReport(self):
+        if self.listener is None:
+            return {}
+        return dict(multicast=self.listener.report())
+
+    def run(self):
+        server_log.info("multicastThread running")
+
+        self.listener = rl_net.MulticastListener(ROOFTOP_MULTICAST_GROUP, ROOFTOP_LIGHTING_PORT, self._handleMessage, log=server_log)
+        server_log.info("Listening on multicast group (%s, %d)", ROOFTOP_MULTICAST_GROUP, ROOFTOP_LIGHTING_PORT)
+        self.listener.serveForever()
+
+    def _handleMessage(self, msg):
+        server_log.debug("Received multicast message: %s", msg)
+        serverThread.dispatcher.dispatch(msg, lambda obj: None)     # no replies by multicast
+
+
+# Flow meter message handlers, flow_t is the flowThread
+
+def flowQueryHandler(msg, reply):
+    # reply() included in lock in case gal, etc are references to flow_t variables
+    with g_flow_lock:
+        gal  = flow_t.flowGal()
+        gpm  = flow_t.flowGPM()
+        zone = flow_t.flowZone()
+        reply((gpm, gal, zone))
+
+def flowHistoryHandler(msg, reply):
+    with open('flowrecord.txt', 'r') as f:
+        history = f.readlines()
+    history.reverse()   # newest first
+    reply(history)
 
 
 
@@ -513,12 +533,15 @@ if node_type in MSG_TYPES['VI_QUERY']:
     vi_t.start()
 if node_type in MSG_TYPES['FLOW_QUERY']:
     flow_t = flowThread()
+    serverThread.registerHandler("FLOW_QUERY", flowQueryHandler)
+    serverThread.registerHandler("FLOW_HISTORY", flowHistoryHandler)
     flow_t.start()
 if node_type in MSG_TYPES['TEMP_QUERY']:
     temp_t = tempThread()
     temp_t.start()
 if node_type in MSG_TYPES['PLAY_AUDIO']:
     audio_t = audioThread()
+    serverThread.registerHandler("SOUND", lambda msg, reply: None)    # get mp3 file and drive output, not implemented yet
     audio_t.start()
 
 
@@ -528,5 +551,10 @@ health_t.start()
 server_t = serverThread(node_type)
 server_t.start()
 
+# after serverThread, which freezes the dispatch table
+if node_type in MSG_TYPES['DISPLAY']:
+    multicast_t = multicastThread()
+    multicast_t.start()
+
 while True:
     pass
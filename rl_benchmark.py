@@ -0,0 +1,526 @@
+#
+
+"""
+
+Benchmarks for the Rooftop Lighting rendering and messaging paths.
+
+Runs on a plain Linux box, no LED strings required.
+
+    python rl_benchmark.py                      # run every benchmark
+    python rl_benchmark.py lut twinkle          # run selected benchmarks by name
+    python rl_benchmark.py --json out.json      # also write the results as JSON
+
+The JSON file holds the platform and a list of {"name": ..., "us": ..., ...} records,
+one per line printed, for tracking regressions across releases.
+
+"""
+
+import json
+import os
+import pickle
+import platform
+import socket
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import headless_neopixel_driver as hdrvr
+import rl_frame_codec
+import rl_lighting
+import rl_msg_codec
+import rl_net
+from   rl_lighting import *
+
+
+def timeit(fn, min_time=0.5):
+    '''Call fn repeatedly for at least min_time seconds, return mean seconds per call.'''
+    n = 0
+    t_start = time.perf_counter()
+    t_end = t_start + min_time
+    while True:
+        fn()
+        n += 1
+        now = time.perf_counter()
+        if now >= t_end:
+            return (now - t_start) / n
+
+
+RESULTS = []
+
+def report(name, seconds, **extra):
+    fields = "".join("  %s=%s" % (k, v) for k, v in extra.items())
+    print ("%-40s %10.1f us%s" % (name, 1e6 * seconds, fields))
+    record = dict(name=name, us=round(1e6 * seconds, 3))
+    record.update(extra)
+    RESULTS.append(record)
+
+
+def unlimitedPower():
+    '''PowerBudget without supplies for the configured headless strings, so renderers write every frame unlimited.'''
+    return PowerBudget.default(hdrvr.N_LEDS_PER_STRING)
+
+
+def frameTimes(frame, min_time=0.3, max_frames=2000):
+    '''Call frame() repeatedly, return the list of per call times in seconds.'''
+    times = []
+    t_end = time.perf_counter() + min_time
+    while len(times) < max_frames:
+        t0 = time.perf_counter()
+        frame()
+        t1 = time.perf_counter()
+        times.append(t1 - t0)
+        if t1 >= t_end:
+            break
+    return times
+
+
+def allocPerFrame(frame, n_frames=20):
+    '''Mean peak bytes allocated while rendering one frame (tracemalloc).'''
+    tracemalloc.start()
+    total = 0
+    for i in range(n_frames):
+        base = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        frame()
+        total += tracemalloc.get_traced_memory()[1] - base
+    tracemalloc.stop()
+    return total // n_frames
+
+
+def set_intensity(color, intensity):
+    '''Per pixel float scaling, the same math as npdrvr.set_intensity().'''
+    return tuple(int(c * intensity) for c in color)
+
+
+def benchLUT(sizes=(100, 1000, 10000)):
+    '''Scale a whole frame: per-pixel set_intensity() vs IntensityLUT.'''
+    for n in sizes:
+        fb = Framebuffer(n)
+        fb.fill((255, 128, 64))
+        pixels = fb.toList()
+
+        def per_pixel():
+            return [set_intensity(p, 0.5) for p in pixels]
+
+        def lut_build():
+            IntensityLUT.clearCache()
+            IntensityLUT.get(0.5, 2.2)
+
+        lut = IntensityLUT.get(0.5)
+        dst = Framebuffer(n)
+
+        def lut_apply():
+            lut.apply(fb, dst)
+
+        report("lut per-pixel set_intensity n=%d" % n, timeit(per_pixel))
+        report("lut apply n=%d" % n, timeit(lut_apply), numpy=fb.use_numpy)
+    report("lut build (not cached)", timeit(lut_build))
+
+
+def benchTwinkle(sizes=(100, 1000, 10000), fps=60):
+    '''One TWINKLE frame, step plus render, against the 1/fps frame budget.'''
+    for n in sizes:
+        fb = Framebuffer(n)
+        tw = TwinkleEngine(n, seed=1)
+
+        def frame():
+            tw.step(1.0 / fps)
+            tw.render(fb, (255, 255, 255))
+
+        t = timeit(frame)
+        report("twinkle frame n=%d" % n, t, budget_pct=round(100 * t * fps, 1), numpy=tw.use_numpy)
+
+
+def benchPatterns(strings=(1, 4, 16), pixels=(100, 1000, 5000, 20000), fps=50):
+    '''Every FencepostRenderer pattern plus a per-post LIGHTING update, render and write to the headless driver.'''
+    for n_strings in strings:
+        for n_pixels in pixels:
+            hdrvr.configure([n_pixels // n_strings] * n_strings, 4, wire_time=False)
+            renderer = FencepostRenderer(hdrvr, 1.0 / fps, power=unlimitedPower())
+            blocks = renderer.geometry.blocks
+            cases = [(pattern, ("DISPLAY", "WHITE", "HIGH", pattern)) for pattern in renderer.PATTERNS]
+            cases.append(("LIGHTING", None))
+
+            for name, style in cases:
+                renderer.restart()
+                if style is None:
+                    post = [0]
+                    def frame():
+                        post[0] = (post[0] + 1) % len(blocks)
+                        renderer.renderLighting(blocks[post[0]][0], blocks[post[0]][1], hdrvr.COLOR_RED, hdrvr.INTENSITY_HIGH)
+                        renderer.flush()
+                else:
+                    def frame():
+                        renderer.renderDisplay(style)
+                        renderer.flush()
+                frame()     # first frame fills caches
+                times = frameTimes(frame)
+                mean = sum(times) / len(times)
+                report("pattern %s strings=%d n=%d" % (name, n_strings, n_pixels), mean,
+                       pattern=name, strings=n_strings, pixels=n_pixels,
+                       fps=round(1.0 / mean, 1),
+                       p50_us=round(1e6 * percentile(times, 50), 1),
+                       p99_us=round(1e6 * percentile(times, 99), 1),
+                       alloc_bytes=allocPerFrame(frame))
+            renderer.close()
+
+
+def benchStrings(strings=(1, 4, 16), leds_per_string=500):
+    '''Frame write time with emulated wire time, strings one after another vs StringPipeline.'''
+    for n_strings in strings:
+        hdrvr.configure([leds_per_string] * n_strings, 4, wire_time=True)
+        fb = Framebuffer(leds_per_string * n_strings)
+
+        def serial():
+            for i in range(n_strings):
+                hdrvr.copy_string_buffer(i, fb.view()[3*leds_per_string*i:3*leds_per_string*(i+1)])
+
+        pipeline = StringPipeline(hdrvr, fb, hdrvr.N_LEDS_PER_STRING)
+        t_serial = timeit(serial)
+        t_parallel = timeit(pipeline.flush)
+        report("strings serial strings=%d" % n_strings, t_serial, strings=n_strings)
+        skew = pipeline.report()
+        report("strings pipeline strings=%d" % n_strings, t_parallel, strings=n_strings,
+               speedup=round(t_serial / t_parallel, 2), skew_us_p50=skew["skew_us_p50"], skew_us_max=skew["skew_us_max"])
+        pipeline.close()
+    hdrvr.configure(wire_time=False)
+
+
+def benchCrossfade(sizes=(100, 1000, 10000, 20000)):
+    '''Blend of two frames, the per frame cost a crossfade adds.'''
+    for n in sizes:
+        a, b, out = Framebuffer(n), Framebuffer(n), Framebuffer(n)
+        a.fill((255, 0, 40))
+        b.fill((0, 200, 40))
+        report("crossfade blend n=%d" % n, timeit(lambda: out.blend(a, b, 0.3)), numpy=out.use_numpy)
+
+
+def benchBatch(pixels=(1000, 5000, 20000)):
+    '''Painting every post: one LIGHTING message (render and flush) per post vs one LIGHTING_BATCH, as list and packed.'''
+    for n_pixels in pixels:
+        hdrvr.configure([n_pixels], 4, wire_time=False)
+        renderer = FencepostRenderer(hdrvr, 0.02, power=unlimitedPower())
+        blocks = renderer.geometry.blocks
+        entries = [(post, orientation, hdrvr.wheel(i), 0.5) for i, (post, orientation, start, stop) in enumerate(blocks)]
+        packed = packLighting(entries)
+
+        def per_message():
+            for post, orientation, color, intensity in entries:
+                renderer.renderLighting(post, orientation, color, intensity)
+                renderer.flush()
+
+        def batch():
+            renderer.renderLightingBatch(entries)
+            renderer.flush()
+
+        def batch_packed():
+            renderer.renderLightingBatch(packed)
+            renderer.flush()
+
+        for name, fn in (("per-message", per_message), ("batch", batch), ("batch packed", batch_packed)):
+            t = timeit(fn)
+            report("lighting %s n=%d" % (name, n_pixels), t, posts=len(entries), posts_per_s=int(len(entries) / t))
+        renderer.close()
+
+
+def benchDelta(strings=(1, 4), pixels=(1000, 20000)):
+    '''Flush cost and bytes written, full frame vs delta, for an unchanged frame, one post changed and every pixel changed.'''
+    for n_strings in strings:
+        for n_pixels in pixels:
+            hdrvr.configure([n_pixels // n_strings] * n_strings, 4, wire_time=False)
+            for delta in (False, True):
+                renderer = FencepostRenderer(hdrvr, 0.02, power=unlimitedPower())
+                renderer.DELTA_FLUSH = delta
+                blocks = renderer.geometry.blocks
+                post = [0]
+
+                def one_post():
+                    post[0] += 1
+                    block = blocks[post[0] % len(blocks)]
+                    renderer.renderLighting(block[0], block[1], hdrvr.wheel(post[0] // len(blocks)), 1.0)
+                    renderer.flush()
+
+                def every_pixel():
+                    post[0] += 1
+                    renderer.fb.fill(hdrvr.wheel(post[0]))
+                    renderer.flush()
+
+                for name, fn in (("unchanged", renderer.flush), ("one post", one_post), ("every pixel", every_pixel)):
+                    renderer.flush()
+                    before = renderer.delta.report()
+                    t = timeit(fn)
+                    after = renderer.delta.report()
+                    calls = max(after["flushes"] + after["skipped"] - before["flushes"] - before["skipped"], 1)
+                    report("flush %s %s strings=%d n=%d" % ("delta" if delta else "full", name, n_strings, n_pixels), t,
+                           bytes_per_flush=(after["bytes"] - before["bytes"]) // calls)
+                renderer.close()
+
+
+def benchCodec(pixels=(100, 1000, 20000), n_frames=50):
+    '''CM to DM frame encoding: encode and decode time and compression ratio of every pattern.'''
+    for n_pixels in pixels:
+        hdrvr.configure([n_pixels], 4, wire_time=False)
+        renderer = FencepostRenderer(hdrvr, 0.02, power=unlimitedPower())
+        buf = bytearray(3 * n_pixels)
+        for color in ("RED", "RAINBOW"):
+            for pattern in renderer.PATTERNS:
+                style = ("DISPLAY", color, "HIGH", pattern)
+                renderer.restart()
+                frames = []
+                for i in range(n_frames):
+                    renderer.renderDisplay(style)
+                    frames.append(renderer.fb.snapshot())
+                encoded = [rl_frame_codec.encodeFrame(f) for f in frames]
+                i = [0]
+
+                def encode():
+                    i[0] += 1
+                    rl_frame_codec.encodeFrame(frames[i[0] % n_frames])
+
+                def decode():
+                    i[0] += 1
+                    rl_frame_codec.decodeFrame(encoded[i[0] % n_frames], buf)
+
+                assert all(rl_frame_codec.decodeFrame(e) == f for e, f in zip(encoded, frames))
+                raw_bytes = sum(len(f) for f in frames)
+                enc_bytes = sum(len(e) for e in encoded)
+                report("codec encode %s %s n=%d" % (color, pattern, n_pixels), timeit(encode, 0.2),
+                       ratio=round(raw_bytes / enc_bytes, 1), bytes_per_frame=enc_bytes // n_frames)
+                report("codec decode %s %s n=%d" % (color, pattern, n_pixels), timeit(decode, 0.2))
+        renderer.close()
+
+
+def benchPalette(pixels=(1000, 5000, 20000), fps=50):
+    '''One frame of a rainbow scrolling along every post: wheel() per post vs a Palette gather.'''
+    for n_pixels in pixels:
+        hdrvr.configure([n_pixels], 4, wire_time=False)
+        renderer = FencepostRenderer(hdrvr, 1.0 / fps, power=unlimitedPower())
+        blocks = renderer.geometry.blocks
+        offset = [0]
+
+        def per_post():
+            offset[0] += 1
+            for i, (post, orientation, start, stop) in enumerate(blocks):
+                renderer.fb.setRange(start, stop, hdrvr.wheel(offset[0] + (256 * i) // len(blocks)))
+
+        def palette():
+            renderer.renderDisplay(("DISPLAY", "RAINBOW", "HIGH", "STEADY"))
+
+        for name, fn in (("per-post wheel", per_post), ("palette", palette)):
+            t = timeit(fn)
+            report("rainbow %s n=%d" % (name, n_pixels), t, budget_pct=round(100 * t * fps, 1), numpy=renderer.fb.use_numpy)
+        renderer.close()
+
+
+def benchDither(pixels=(1000, 5000, 20000)):
+    '''THROB frame at LOW intensity, 8 bit vs temporally dithered, against the DITHER_FPS frame budget.'''
+    style = ("DISPLAY", "WHITE", "LOW", "THROB")
+    for n_pixels in pixels:
+        hdrvr.configure([n_pixels], 4, wire_time=False)
+        for dither in (False, True):
+            renderer = FencepostRenderer(hdrvr, 0.02, power=unlimitedPower())
+            renderer.DITHER = dither
+
+            def frame():
+                renderer.renderDisplay(style)
+
+            t = timeit(frame)
+            report("throb %s n=%d" % ("dithered" if dither else "8 bit", n_pixels), t,
+                   budget_pct=round(100 * t * renderer.DITHER_FPS, 1), numpy=renderer.fb.use_numpy)
+            renderer.close()
+
+
+def benchPower(strings=(1, 4, 16), pixels=(1000, 5000, 20000)):
+    '''PowerBudget.limit() per frame, one supply per string, within budget (copy) and over budget (dimmed).'''
+    for n_strings in strings:
+        for n_pixels in pixels:
+            leds_per_string = [n_pixels // n_strings] * n_strings
+            src, dst = Framebuffer(sum(leds_per_string)), Framebuffer(sum(leds_per_string))
+            src.fill((255, 255, 255))
+            for name, budget_ma in (("within", 10**9), ("over", 1000)):
+                power = PowerBudget([([i], budget_ma) for i in range(n_strings)], leds_per_string)
+                report("power %s strings=%d n=%d" % (name, n_strings, n_pixels), timeit(lambda: power.limit(src, dst)),
+                       numpy=src.use_numpy)
+
+
+def benchVideo(pixels=(1000, 5000, 20000), size=(320, 180), n_frames=50, fps=50):
+    '''Full roof video: map a memory-mapped PPM frame onto every pixel, plus intensity, against the 1/fps frame budget.'''
+    width, height = size
+    fd, path = tempfile.mkstemp(suffix=".ppm")
+    with os.fdopen(fd, "wb") as f:
+        for k in range(n_frames):
+            f.write(b"P6\n%d %d\n255\n" % (width, height))
+            f.write(bytes((x + k) & 0xff for x in range(3 * width)) * height)
+    try:
+        for n_pixels in pixels:
+            hdrvr.configure([n_pixels], 4, wire_time=False)
+            renderer = FencepostRenderer(hdrvr, 1.0 / fps, power=unlimitedPower())
+            style = ("VIDEO", path, "HIGH", None, None, fps)
+
+            def frame():
+                renderer.renderVideo(style)
+                renderer.flush()
+
+            frame()     # opens the video, builds the sampling index
+            t = timeit(frame)
+            report("video %dx%d n=%d" % (width, height, n_pixels), t, budget_pct=round(100 * t * fps, 1),
+                   alloc_bytes=allocPerFrame(frame), numpy=renderer.fb.use_numpy)
+            renderer.close()
+    finally:
+        os.remove(path)
+
+
+def benchFraming():
+    '''Messages per second over loopback: legacy connection per message vs a persistent framed connection.'''
+    def handle(msg, reply):
+        if msg[0] == "VI_QUERY":
+            reply((48.1, 250.0))
+
+    server = rl_net.TCPServer(0, lambda client, addr: rl_net.serveConnection(client, handle), log=None)
+    threading.Thread(target=server.serveForever, daemon=True).start()
+
+    def legacy(msg):
+        s = socket.create_connection(("127.0.0.1", server.port))
+        s.sendall(pickle.dumps(msg, pickle.HIGHEST_PROTOCOL))
+        s.shutdown(socket.SHUT_WR)
+        chunks = []
+        while True:
+            data = s.recv(4096)
+            if not data:
+                break
+            chunks.append(data)
+        s.close()
+        return pickle.loads(b"".join(chunks)) if chunks else None
+
+    client = rl_net.FramedClient("127.0.0.1", server.port, binary=False)
+    binary = rl_net.FramedClient("127.0.0.1", server.port)
+    display = ("DISPLAY", "RED", "HIGH", "STEADY")
+    query = ("VI_QUERY",)
+    assert legacy(query) == client.request(query) == binary.request(query)
+    for name, fn in (("legacy DISPLAY", lambda: legacy(display)),
+                     ("legacy VI_QUERY", lambda: legacy(query)),
+                     ("framed DISPLAY", lambda: client.send(display)),
+                     ("framed VI_QUERY", lambda: client.request(query)),
+                     ("binary DISPLAY", lambda: binary.send(display)),
+                     ("binary VI_QUERY", lambda: binary.request(query))):
+        t = timeit(fn)
+        report("messages %s" % name, t, msgs_per_s=int(1 / t))
+    client.request(query)   # every DISPLAY sent has been handled
+    binary.request(query)
+    client.close()
+    binary.close()
+    server.close()
+
+
+def benchWire():
+    '''Encode and decode time and size per message type, rl_msg_codec binary vs pickle.'''
+    health = dict(node="rooftop", uptime=86400, lighting=dict(frames=dict(p50_ms=1.2, p99_ms=4.8)), server=dict(active=2))
+    messages = (("DISPLAY", "RED", "HIGH", "STEADY"),
+                ("LIGHTING", 12, "N", (255, 128, 0), 0.8),
+                ("LIGHTING_BATCH", packLighting([(post, "N", (post, 0, 255 - post), 1.0) for post in range(64)])),
+                ("VI_QUERY",),
+                ("HEALTH_NOTICE", health))
+    responses = (("VI_QUERY", (48.1, 250.0)),
+                 ("VI_HISTORY", [(48.0 + k / 10, 250.0 + k) for k in range(10)]),
+                 ("FLOW_QUERY", (2.5, 103.0, "front")))
+
+    for msg in messages:
+        name = msg[0]
+        data = rl_msg_codec.encodeMessage(msg)
+        pickled = pickle.dumps(msg, pickle.HIGHEST_PROTOCOL)
+        assert rl_msg_codec.decodeMessage(name, data)[1:] == msg[1:] or name in ("LIGHTING", "LIGHTING_BATCH")
+        report("wire %s binary encode" % name, timeit(lambda: rl_msg_codec.encodeMessage(msg)), size=len(data))
+        report("wire %s binary decode" % name, timeit(lambda: rl_msg_codec.decodeMessage(name, data)), size=len(data))
+        report("wire %s pickle encode" % name, timeit(lambda: pickle.dumps(msg, pickle.HIGHEST_PROTOCOL)), size=len(pickled))
+        report("wire %s pickle decode" % name, timeit(lambda: pickle.loads(pickled)), size=len(pickled))
+
+    for name, obj in responses:
+        data = rl_msg_codec.encodeResponse(name, obj)
+        pickled = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+        assert rl_msg_codec.decodeResponse(name, data) == obj
+        report("wire %s response binary decode" % name, timeit(lambda: rl_msg_codec.decodeResponse(name, data)), size=len(data))
+        report("wire %s response pickle decode" % name, timeit(lambda: pickle.loads(pickled)), size=len(pickled))
+
+
+def benchMulticast(n_nodes=4, n_scenes=200):
+    '''Time for a DISPLAY scene change to reach n_nodes listeners on loopback: TCP to each node in turn vs one multicast datagram.'''
+    group, port = "239.255.76.63", 17663
+    arrivals = []
+    lock = threading.Lock()
+
+    def handle(msg, reply=None):
+        with lock:
+            arrivals.append(time.perf_counter())
+
+    listeners = [rl_net.MulticastListener(group, port, handle, "127.0.0.1") for k in range(n_nodes)]
+    servers = [rl_net.TCPServer(0, lambda client, addr: rl_net.serveConnection(client, handle), log=None) for k in range(n_nodes)]
+    for node in listeners + servers:
+        threading.Thread(target=node.serveForever, daemon=True).start()
+    clients = [rl_net.FramedClient("127.0.0.1", server.port) for server in servers]
+    senders = [rl_net.MulticastSender(group, port, repeat=repeat, interface="127.0.0.1") for repeat in (0, 2)]
+
+    def tcp(msg):
+        for client in clients:
+            client.send(msg)
+
+    for name, send in (("tcp", tcp), ("multicast", senders[0].send), ("multicast repeat=2", senders[1].send)):
+        latency = []
+        spread = []
+        for k in range(n_scenes):
+            del arrivals[:]
+            t_start = time.perf_counter()
+            send(("DISPLAY", ("RED", "GREEN", "BLUE")[k % 3], "HIGH", "STEADY"))
+            t_end = time.perf_counter() + 1.0
+            while len(arrivals) < n_nodes and time.perf_counter() < t_end:
+                time.sleep(0.0001)
+            with lock:
+                if len(arrivals) < n_nodes:
+                    continue    # lost, counted by the listeners
+                latency.append(max(arrivals) - t_start)
+                spread.append(max(arrivals) - min(arrivals))
+        report("scene %s nodes=%d" % (name, n_nodes), percentile(latency, 50),
+               p99_us=round(1e6 * percentile(latency, 99), 1), spread_us=round(1e6 * percentile(spread, 50), 1),
+               delivered=len(latency), scenes=n_scenes)
+        time.sleep(0.05)    # repeats still in flight
+    report("scene multicast duplicates suppressed", 0.0, duplicates=sum(l.report()["duplicates"] for l in listeners),
+           lost=sum(l.report()["lost"] for l in listeners))
+
+    for node in senders + clients + listeners + servers:
+        node.close()
+
+
+BENCHMARKS = {
+    "lut"     : benchLUT,
+    "twinkle" : benchTwinkle,
+    "patterns": benchPatterns,
+    "strings" : benchStrings,
+    "crossfade": benchCrossfade,
+    "batch"   : benchBatch,
+    "delta"   : benchDelta,
+    "codec"   : benchCodec,
+    "palette" : benchPalette,
+    "dither"  : benchDither,
+    "power"   : benchPower,
+    "video"   : benchVideo,
+    "framing" : benchFraming,
+    "wire"    : benchWire,
+    "multicast": benchMulticast,
+}
+
+# main
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    json_path = None
+    if "--json" in args:
+        i = args.index("--json")
+        json_path = args[i+1]
+        del args[i:i+2]
+    for name in args or list(BENCHMARKS):
+        BENCHMARKS[name]()
+    if json_path:
+        with open(json_path, "w") as f:
+            json.dump(dict(python=platform.python_version(), machine=platform.machine(),
+                           numpy=rl_lighting.numpy is not None, results=RESULTS), f, indent=1)
@@ -0,0 +1,157 @@
+#
+
+"""
+
+Compressed frame encoding for the Control Module (CM) to Distribution Module
+(DM) link.
+
+A frame is n_pixels r, g, b bytes. Most patterns send few distinct colors in
+long runs (STEADY, STROBE and THROB are a single color), so a frame is sent
+as runs of palette indexes instead of shifting out 3 bytes per pixel. A
+uniform frame of up to 2 million pixels encodes to 14 bytes or fewer.
+
+Encoded frame, all counts are unsigned LEB128 varints:
+    u8      format      FORMAT_RAW, FORMAT_RLE or FORMAT_PALETTE
+    varint  n_pixels
+    RAW     r, g, b bytes for every pixel
+    RLE     runs of (varint count, r, g, b) until n_pixels are covered
+    PALETTE u8 palette size - 1, palette r, g, b bytes,
+            runs of (varint count, u8 palette index) until n_pixels are covered
+
+encodeFrame() picks the smallest of the three. It runs on the CM and uses
+numpy when available. decodeFrame() runs on the DM and only uses what
+MicroPython provides.
+
+"""
+
+try:
+    import numpy
+except ImportError:     # always the case on the DM
+    numpy = None
+
+
+FORMAT_RAW      = 0
+FORMAT_RLE      = 1
+FORMAT_PALETTE  = 2
+
+MAX_PALETTE     = 256
+
+
+def _putVarint(out, n):
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+def _getVarint(data, i):
+    '''Return (value, index after the varint).'''
+    n = 0
+    shift = 0
+    while True:
+        b = data[i]
+        i += 1
+        n |= (b & 0x7f) << shift
+        if b < 0x80:
+            return n, i
+        shift += 7
+
+def frameRuns(frame, max_runs=None):
+    '''List of (pixel count, r, g, b bytes) runs of equal pixels in frame, None if there are more than max_runs.'''
+    n3 = len(frame)
+    if numpy is not None and n3 > 3:
+        pixels = numpy.frombuffer(frame, dtype=numpy.uint8).reshape(-1, 3)
+        starts = numpy.flatnonzero((pixels[1:] != pixels[:-1]).any(axis=1)) + 1
+        if max_runs is not None and len(starts) >= max_runs:
+            return None
+        bounds = [0] + starts.tolist() + [n3 // 3]
+        frame = bytes(frame)
+        return [(bounds[k+1] - bounds[k], frame[3*bounds[k]:3*bounds[k]+3]) for k in range(len(bounds) - 1)]
+
+    # run lengths by galloping: compare runs of 1, 2, 4, ... pixels at C speed
+    frame = bytes(frame)
+    runs = []
+    i = 0
+    while i < n3:
+        p = frame[i:i+3]
+        j = i + 3
+        step = 1
+        while True:
+            if frame.startswith(p * step, j):
+                j += 3 * step
+                step *= 2
+            elif step > 1:
+                step //= 2
+            else:
+                break
+        runs.append(((j - i) // 3, p))
+        if max_runs is not None and len(runs) > max_runs:
+            return None
+        i = j
+    return runs
+
+def encodeFrame(frame):
+    '''Encode frame, any bytes-like object of r, g, b bytes, in the smallest format. Returns bytes.'''
+    n_pixels = len(frame) // 3
+    out = bytearray()
+    # runs cost at least 2 bytes, so more than 1.5 runs per pixel can't beat raw
+    runs = frameRuns(frame, max_runs=(3 * n_pixels) // 2)
+    if runs is not None:
+        colors = {}
+        for count, p in runs:
+            if p not in colors:
+                colors[p] = len(colors)
+                if len(colors) > MAX_PALETTE:
+                    break
+        if len(colors) <= MAX_PALETTE:
+            out.append(FORMAT_PALETTE)
+            _putVarint(out, n_pixels)
+            out.append(len(colors) - 1 if colors else 0)
+            for p in colors:                # dicts keep insertion order, index order
+                out += p
+            for count, p in runs:
+                _putVarint(out, count)
+                out.append(colors[p])
+        else:
+            out.append(FORMAT_RLE)
+            _putVarint(out, n_pixels)
+            for count, p in runs:
+                _putVarint(out, count)
+                out += p
+    if runs is None or len(out) > 3 * n_pixels:
+        out = bytearray([FORMAT_RAW])
+        _putVarint(out, n_pixels)
+        out += frame
+    return bytes(out)
+
+def decodeFrame(data, buf=None):
+    '''Decode an encodeFrame() frame into bytearray buf (allocated if None), return buf.
+
+    MicroPython compatible, so the DM can decode into its local pixel buffer.
+    '''
+    fmt = data[0]
+    n_pixels, i = _getVarint(data, 1)
+    if buf is None:
+        buf = bytearray(3 * n_pixels)
+    if fmt == FORMAT_RAW:
+        buf[0:3*n_pixels] = data[i:i+3*n_pixels]
+        return buf
+    if fmt == FORMAT_PALETTE:
+        n_colors = data[i] + 1
+        i += 1
+        palette = [bytes(data[i+3*k:i+3*k+3]) for k in range(n_colors)]
+        i += 3 * n_colors
+    elif fmt != FORMAT_RLE:
+        raise ValueError("unknown frame format %d" % fmt)
+    j = 0
+    end = 3 * n_pixels
+    while j < end:
+        count, i = _getVarint(data, i)
+        if fmt == FORMAT_PALETTE:
+            p = palette[data[i]]
+            i += 1
+        else:
+            p = bytes(data[i:i+3])
+            i += 3
+        buf[j:j+3*count] = p * count
+        j += 3 * count
+    return buf
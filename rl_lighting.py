@@ -0,0 +1,1552 @@
+#
+
+"""
+
+Lighting engine building blocks for the Rooftop Lighting Control Module (CM).
+
+Nothing in this module touches hardware, so it can be imported by rl.py on
+the CM as well as by benchmarks and tools running on a plain Linux box.
+
+"""
+
+import bisect
+import collections
+import concurrent.futures
+import math
+import mmap
+import operator
+import os
+import queue
+import random
+import stat
+import struct
+import threading
+import time
+
+import rl_frame_codec
+
+try:
+    import numpy
+except ImportError:     # numpy is optional, Framebuffer falls back to bytearray
+    numpy = None
+
+
+def percentile(samples, pct):
+    '''Return the pct (0-100) percentile of samples, 0.0 if there are none.'''
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    i = int(round((pct / 100.0) * (len(ordered) - 1)))
+    return ordered[i]
+
+
+class LatencyHistogram:
+    # Fixed bucket histogram of latencies plus a window of raw samples
+    # for exact percentiles. Bucket edges are upper bounds in milliseconds.
+    BUCKETS_MS  = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+    WINDOW      = 1000
+
+    def __init__(self):
+        self.counts  = [0] * (len(self.BUCKETS_MS) + 1)     # last bucket is overflow
+        self.samples = collections.deque(maxlen=self.WINDOW)
+
+    def record(self, seconds):
+        ms = 1000 * seconds
+        i = 0
+        while i < len(self.BUCKETS_MS) and ms > self.BUCKETS_MS[i]:
+            i += 1
+        self.counts[i] += 1
+        self.samples.append(seconds)
+
+    def report(self):
+        samples = list(self.samples)
+        buckets = dict(("<=%gms" % edge, n) for edge, n in zip(self.BUCKETS_MS, self.counts))
+        buckets[">%gms" % self.BUCKETS_MS[-1]] = self.counts[-1]
+        return dict(n=sum(self.counts), buckets=buckets,
+                    ms_p50=round(1000 * percentile(samples, 50), 3),
+                    ms_p99=round(1000 * percentile(samples, 99), 3),
+                    ms_max=round(1000 * max(samples, default=0.0), 3))
+
+
+class FrameScheduler:
+    # Paces a render loop from absolute time.monotonic() deadlines.
+    # Each deadline is computed from the previous deadline, not from the time
+    # the previous frame finished, so render and driver write time do not
+    # accumulate as drift.
+    #
+    # Usage:
+    #   msg = sched.wait(interval, cmd_q)   # sleep until the next deadline or a new command
+    #   <render, write to driver>
+    #   sched.frameDone()                   # record render time and command latency
+    #
+    # Command queue entries are (time.monotonic() when queued, message) so the
+    # time from a command being queued to its first frame being written to the
+    # driver ("command to photon") can be measured.
+    POLICY_SKIP     = "SKIP"        # drop missed frames, realign to the original frame grid
+    POLICY_CATCHUP  = "CATCHUP"     # render missed frames back to back until caught up
+    MAX_CATCHUP     = 5             # frames, beyond this CATCHUP gives up and resyncs to now
+    STATS_WINDOW    = 500           # number of recent frames kept for statistics
+
+    def __init__(self, fps=50.0, policy=POLICY_SKIP, clock=time.monotonic, sleep=time.sleep):
+        self.clock  = clock
+        self.sleep  = sleep
+        self.policy = policy
+        self.setFps(fps)
+        self.deadline    = self.clock()
+        self.frame_start = self.deadline
+        self.n_frames    = 0
+        self.n_late      = 0
+        self.n_skipped   = 0
+        self.render_times = collections.deque(maxlen=self.STATS_WINDOW)
+        self.late_times   = collections.deque(maxlen=self.STATS_WINDOW)
+        self.cmd_latency  = LatencyHistogram()
+        self.cmd_time     = None    # queue time of the command being rendered this frame
+
+    def setFps(self, fps):
+        self.fps    = float(fps)
+        self.period = 1.0 / self.fps
+
+    def resync(self):
+        '''Restart the deadline grid from now, e.g. after a pattern change.'''
+        self.deadline = self.clock()
+
+    def _advance(self, interval):
+        '''Move to the next deadline, apply the late frame policy. Return seconds until the deadline.'''
+        if interval is None:
+            interval = self.period
+        self.deadline += interval
+        now = self.clock()
+        late = now - self.deadline
+        if late > 0:
+            self.n_late += 1
+            if self.policy == self.POLICY_SKIP:
+                missed = int(late / interval) if interval > 0 else 0
+                if missed:
+                    self.n_skipped += missed
+                    self.deadline  += missed * interval
+            elif late > self.MAX_CATCHUP * interval:
+                self.n_skipped += int(late / interval) if interval > 0 else 0
+                self.deadline = now
+        return self.deadline - now
+
+    def _frameStart(self):
+        self.frame_start = self.clock()
+        self.late_times.append(max(0.0, self.frame_start - self.deadline))
+        self.n_frames += 1
+
+    def wait(self, interval=None, cmd_q=None):
+        '''Sleep until the next deadline, interval seconds after the previous one (default 1/fps).
+
+        If cmd_q is given, wake as soon as a command arrives and return the
+        message, restarting the deadline grid from now. Otherwise return None.
+        '''
+        remaining = self._advance(interval)
+        msg = None
+        if cmd_q is None:
+            if remaining > 0:
+                self.sleep(remaining)
+        else:
+            try:
+                if remaining > 0:
+                    entry = cmd_q.get(timeout=remaining)
+                else:
+                    entry = cmd_q.get_nowait()
+            except queue.Empty:
+                pass
+            else:
+                cmd_q.task_done()
+                self.cmd_time, msg = entry
+                self.deadline = min(self.deadline, self.clock())
+        self._frameStart()
+        return msg
+
+    def frameDone(self):
+        '''Call after the frame has been rendered and written to the driver.'''
+        now = self.clock()
+        self.render_times.append(now - self.frame_start)
+        if self.cmd_time is not None:
+            self.cmd_latency.record(now - self.cmd_time)
+            self.cmd_time = None
+
+    def stats(self):
+        '''Frame timing statistics, times in milliseconds.'''
+        render = list(self.render_times)
+        late   = list(self.late_times)
+        return dict(fps=self.fps, policy=self.policy,
+                    frames=self.n_frames, late=self.n_late, skipped=self.n_skipped,
+                    render_ms_p50=round(1000 * percentile(render, 50), 3),
+                    render_ms_p99=round(1000 * percentile(render, 99), 3),
+                    render_ms_max=round(1000 * max(render, default=0.0), 3),
+                    late_ms_p50=round(1000 * percentile(late, 50), 3),
+                    late_ms_p99=round(1000 * percentile(late, 99), 3),
+                    late_ms_max=round(1000 * max(late, default=0.0), 3),
+                    cmd_latency=self.cmd_latency.report())
+
+
+class Framebuffer:
+    # Pixel state for every LED as one contiguous buffer of r, g, b bytes.
+    # Backed by a numpy uint8 array when numpy is available, bytearray otherwise.
+    # Pixel colors are (r, g, b) tuples as returned by npdrvr.set_intensity().
+    BYTES_PER_PIXEL = 3
+
+    def __init__(self, n_pixels, use_numpy=True):
+        self.n_pixels = n_pixels
+        self.use_numpy = use_numpy and numpy is not None
+        if self.use_numpy:
+            self.pixels = numpy.zeros((n_pixels, self.BYTES_PER_PIXEL), dtype=numpy.uint8)
+            self.buf = self.pixels.reshape(-1)      # flat view, shares memory with self.pixels
+        else:
+            self.pixels = None
+            self.buf = bytearray(self.BYTES_PER_PIXEL * n_pixels)
+
+    def __len__(self):
+        return self.n_pixels
+
+    def view(self):
+        '''Zero copy memoryview of the raw r, g, b bytes.'''
+        return memoryview(self.buf)
+
+    def fill(self, color):
+        self.setRange(0, self.n_pixels, color)
+
+    def setRange(self, start, stop, color):
+        '''Set pixels start..stop-1 to color.'''
+        if self.use_numpy:
+            self.pixels[start:stop] = color
+        else:
+            self.buf[3*start:3*stop] = bytes(color) * (stop - start)
+
+    def copyFrom(self, data, start=0):
+        '''Copy r, g, b bytes from data, any bytes-like object, into the frame starting at pixel start.'''
+        i = 3 * start
+        if self.use_numpy:
+            self.buf[i:i+len(data)] = numpy.frombuffer(data, dtype=numpy.uint8)
+        else:
+            self.buf[i:i+len(data)] = data
+
+    def blend(self, a, b, x):
+        '''Set this frame to Framebuffer a faded x (0.0 - 1.0) of the way to Framebuffer b.'''
+        # floor(a * (256-w) / 256) + floor(b * w / 256) on both backends, so
+        # they give identical frames. The sum is <= 255, so adding the two
+        # scaled frames as big integers adds every byte without carries.
+        w = min(max(int(x * 256), 0), 256)     # weight of b, 0 - 256
+        if self.use_numpy and a.use_numpy and b.use_numpy:
+            mix = (a.buf.astype(numpy.uint16) * (256 - w)) >> 8
+            mix += (b.buf.astype(numpy.uint16) * w) >> 8
+            self.buf[:] = mix
+        else:
+            ta, tb = _blendTables(w)
+            n = len(self.buf)
+            mix = int.from_bytes(bytes(a.buf).translate(ta), "little") + \
+                  int.from_bytes(bytes(b.buf).translate(tb), "little")
+            self.buf[:] = mix.to_bytes(n, "little")
+
+    def snapshot(self):
+        '''Copy of the raw r, g, b bytes.'''
+        return bytes(self.view())
+
+    def toList(self):
+        '''Pixels as a list of (r, g, b) tuples, the format of npdrvr.copy_all_pixels().'''
+        b = bytes(self.buf)
+        return list(zip(b[0::3], b[1::3], b[2::3]))
+
+    def flush(self, driver):
+        '''Write the frame to the driver.
+
+        Drivers that accept a raw buffer (copy_buffer()) get a zero copy view,
+        older drivers get the list of tuples copy_all_pixels() expects.
+        '''
+        if hasattr(driver, "copy_buffer"):
+            driver.copy_buffer(self.view())
+        else:
+            driver.copy_all_pixels(self.toList())
+
+
+_blend_tables = {}
+
+def _blendTables(w):
+    '''Tables scaling a byte by (256-w)/256 and by w/256, rounded down.'''
+    tables = _blend_tables.get(w)
+    if tables is None:
+        tables = (bytes((v * (256 - w)) >> 8 for v in range(256)), bytes((v * w) >> 8 for v in range(256)))
+        _blend_tables[w] = tables
+    return tables
+
+
+class IntensityLUT:
+    # Per-channel 256 entry lookup tables mapping a full brightness channel
+    # value to its output value at one intensity, gamma and calibration.
+    # Applying the tables to a framebuffer is one vector operation per
+    # channel (numpy take or bytes.translate) instead of float math per pixel.
+    #
+    # Tables are cached by (intensity, gamma, calibration) and only built
+    # the first time a combination is used.
+    #
+    # output = round(255 * ((value / 255) * intensity * calibration[channel]) ** gamma)
+    # gamma 1.0 matches the linear scaling of npdrvr.set_intensity().
+    CACHE_SIZE  = 64        # THROB alone uses THROB_STEPS + 1 intensities
+    _cache      = collections.OrderedDict()
+
+    def __init__(self, intensity, gamma=1.0, calibration=(1.0, 1.0, 1.0)):
+        self.intensity = intensity
+        self.gamma = gamma
+        self.calibration = tuple(calibration)
+        self.tables = tuple(self._buildTable(intensity * k, gamma) for k in self.calibration)
+        if numpy is not None:
+            self.np_tables = numpy.array([numpy.frombuffer(t, dtype=numpy.uint8) for t in self.tables])
+            self.np_channel = numpy.arange(3)
+
+    @staticmethod
+    def _buildTable(scale, gamma):
+        scale = min(max(scale, 0.0), 1.0)
+        return bytes(int(round(255 * ((v / 255.0) * scale) ** gamma)) for v in range(256))
+
+    @classmethod
+    def get(cls, intensity, gamma=1.0, calibration=(1.0, 1.0, 1.0)):
+        '''Return the cached table for these parameters, building it if needed.'''
+        key = (intensity, gamma, tuple(calibration))
+        lut = cls._cache.get(key)
+        if lut is None:
+            lut = cls(intensity, gamma, calibration)
+            cls._cache[key] = lut
+            if len(cls._cache) > cls.CACHE_SIZE:
+                cls._cache.popitem(last=False)
+        else:
+            cls._cache.move_to_end(key)
+        return lut
+
+    @classmethod
+    def clearCache(cls):
+        '''Call when the calibration changes.'''
+        cls._cache.clear()
+
+    def color(self, color):
+        '''Scale one (r, g, b) color.'''
+        return tuple(t[c] for t, c in zip(self.tables, color))
+
+    @staticmethod
+    def scaleColor(color, intensity, gamma=1.0, calibration=(1.0, 1.0, 1.0), full_scale=255):
+        '''Scale one (r, g, b) color with the table formula, without building (or caching) a table.
+
+        For per frame intensities that change continuously (e.g. THROB), where
+        a table per intensity would never be reused. full_scale 0xff00 gives
+        8.8 fixed point channels for TemporalDither.
+        '''
+        return tuple(int(round(full_scale * ((c / 255.0) * min(max(intensity * k, 0.0), 1.0)) ** gamma))
+                     for c, k in zip(color, calibration))
+
+    def apply(self, src, dst=None):
+        '''Scale every pixel of Framebuffer src into dst (default src, in place).'''
+        if dst is None:
+            dst = src
+        if src.use_numpy and dst.use_numpy:
+            dst.pixels[:] = self.np_tables[self.np_channel, src.pixels]     # one gather for all channels
+        else:
+            for ch in range(3):
+                dst.buf[ch::3] = bytes(src.buf[ch::3]).translate(self.tables[ch])
+
+
+class Palette:
+    # Color table of size entries built from gradient stops, for colors that
+    # vary from post to post. A frame is one gather of the table through a
+    # per-pixel palette index, so scrolling the palette along every post
+    # costs one operation per frame: numpy take with the offset added to the
+    # index, or without numpy, one bytes.translate per channel through a
+    # rotated 256 entry copy of the table.
+    #
+    # Stops are (position 0.0 - 1.0, (r, g, b)), linearly interpolated. The
+    # table wraps from the last entry to the first, so palettes meant to
+    # scroll should end with the color they start with.
+    SIZE = 256
+
+    def __init__(self, stops, size=SIZE):
+        self.stops = sorted((float(pos), tuple(color)) for pos, color in stops)
+        self.size = size
+        self.table = bytes(c for i in range(size) for c in self._interpolate(i / size))
+        self._buildChannels()
+
+    def _buildChannels(self):
+        # 256 entry table per channel for bytes.translate, resampled if size isn't 256
+        self.channels = tuple(bytes(self.table[3 * (i * self.size // 256) + ch] for i in range(256)) for ch in range(3))
+        if numpy is not None:
+            self.np_table = numpy.frombuffer(self.table, dtype=numpy.uint8).reshape(-1, 3)
+
+    def _interpolate(self, pos):
+        stops = self.stops
+        if pos <= stops[0][0]:
+            return stops[0][1]
+        for (p0, c0), (p1, c1) in zip(stops, stops[1:]):
+            if pos <= p1:
+                x = (pos - p0) / (p1 - p0) if p1 > p0 else 1.0
+                return tuple(int(round(a + (b - a) * x)) for a, b in zip(c0, c1))
+        return stops[-1][1]
+
+    @classmethod
+    def fromConfig(cls, config, size=SIZE):
+        '''Dictionary of the custom palettes in the "palettes" entry of the configuration, {NAME : [[position, [r, g, b]], ...]}.'''
+        return dict((name.upper(), cls(stops, size)) for name, stops in config.get("palettes", {}).items())
+
+    def color(self, i):
+        '''(r, g, b) of entry i, wrapping.'''
+        i = 3 * (i % self.size)
+        return tuple(self.table[i:i+3])
+
+    def scaled(self, lut):
+        '''Copy of this palette with every entry scaled by IntensityLUT lut.'''
+        palette = Palette.__new__(Palette)
+        palette.stops = self.stops
+        palette.size = self.size
+        table = bytearray(self.table)
+        for ch in range(3):
+            table[ch::3] = self.table[ch::3].translate(lut.tables[ch])
+        palette.table = bytes(table)
+        palette._buildChannels()
+        return palette
+
+    def index(self, positions):
+        '''Per-pixel palette index for this palette\'s size, from a position 0.0 - 1.0 per pixel.
+
+        Returns (256 entry index bytes, numpy index array or None), reusable for every palette of the same size.
+        '''
+        index8 = bytes(int(p * 256) % 256 for p in positions)
+        np_index = None
+        if numpy is not None:
+            np_index = (numpy.asarray(positions, dtype=numpy.float64) * self.size).astype(numpy.intp) % self.size
+        return index8, np_index
+
+    def render(self, fb, index, offset=0.0):
+        '''Set every pixel of fb to its palette color, scrolled by offset (0.0 - 1.0 of the palette).'''
+        index8, np_index = index
+        if fb.use_numpy and np_index is not None:
+            numpy.take(self.np_table, np_index + int(offset * self.size), axis=0, mode="wrap", out=fb.pixels)
+        else:
+            o = int(offset * 256) % 256
+            for ch in range(3):
+                t = self.channels[ch]
+                fb.buf[ch::3] = index8.translate(t[o:] + t[:o])
+
+
+class TemporalDither:
+    # 16 bit (8.8 fixed point) frame dithered into the 8 bit output frame
+    # across frames: each channel's fraction below 8 bits is carried to the
+    # next frame, so over a few frames a pixel averages to the 16 bit value.
+    # A level between two 8 bit steps shows as the two steps alternating,
+    # which at a high frame rate is seen as the level in between.
+    #
+    # The carried errors start at PHASES different values along the string,
+    # so neighbouring pixels of a uniform fill step at different frames
+    # instead of flickering together.
+    #
+    # With numpy, target is a per-pixel (n, 3) uint16 frame and render() is
+    # one vectorized pass. Without numpy only uniform fills are dithered:
+    # pixels with the same phase stay identical, so PHASES pixels are
+    # dithered and tiled along the frame.
+    PHASES      = 16
+    MAX_LEVEL   = 0xff00            # 255.0, the highest 8.8 fixed point level
+
+    def __init__(self, n_pixels, use_numpy=True):
+        self.n_pixels = n_pixels
+        self.use_numpy = use_numpy and numpy is not None
+        seeds = [((k * 11) % self.PHASES) * (256 // self.PHASES) for k in range(self.PHASES)]
+        self.color = (0, 0, 0)      # uniform target, 8.8 fixed point
+        if self.use_numpy:
+            self.target = numpy.zeros((n_pixels, 3), dtype=numpy.uint16)
+            phase = numpy.array(seeds, dtype=numpy.uint16)[numpy.arange(n_pixels) % self.PHASES]
+            self.error = numpy.repeat(phase[:, None], 3, axis=1)
+            self.acc = numpy.zeros((n_pixels, 3), dtype=numpy.uint16)   # scratch, no per frame allocation
+        else:
+            self.error = [[s, s, s] for s in seeds]
+
+    def fill(self, color16):
+        '''Set every pixel of the 16 bit frame to (r, g, b) 8.8 fixed point color16.'''
+        self.color = tuple(min(max(int(c), 0), self.MAX_LEVEL) for c in color16)
+        if self.use_numpy:
+            self.target[:] = self.color
+
+    def render(self, fb):
+        '''Dither the 16 bit frame into Framebuffer fb and carry the errors to the next frame.'''
+        if self.use_numpy and fb.use_numpy:
+            numpy.add(self.target, self.error, out=self.acc)    # <= 0xff00 + 0xff, no overflow
+            numpy.bitwise_and(self.acc, 0xff, out=self.error)
+            numpy.right_shift(self.acc, 8, out=self.acc)
+            fb.pixels[:] = self.acc
+            return
+        tile = bytearray(3 * self.PHASES)
+        for k, error in enumerate(self.error):
+            for ch in range(3):
+                acc = self.color[ch] + error[ch]
+                error[ch] = acc & 0xff
+                tile[3*k+ch] = acc >> 8
+        n = 3 * self.n_pixels
+        fb.buf[:] = (bytes(tile) * (n // len(tile) + 1))[:n]
+
+
+class MarchPattern:
+    # Posts on, posts off, marching one post per step.
+    # The on/off pattern is rendered once, tiled to cover the string plus one
+    # pattern period, so the pattern rotated by any number of posts is a
+    # contiguous slice of it. A step only changes the start offset.
+    def __init__(self, n_pixels, leds_per_post, color, on_posts=2, off_posts=2, direction=1):
+        self.color = tuple(color)
+        self.n_pixels = n_pixels
+        self.post_bytes = 3 * leds_per_post
+        self.period = on_posts + off_posts                  # pattern length in posts
+        self.direction = 1 if direction >= 0 else -1        # 1 = towards the end of the string
+        one_period = bytes(self.color) * (leds_per_post * on_posts) + bytes(self.post_bytes * off_posts)
+        n_periods = -(-n_pixels // (leds_per_post * self.period)) + 1     # ceil() + 1
+        self.pattern = memoryview(one_period * n_periods)
+        self.offset = 0     # posts
+
+    def step(self):
+        self.offset = (self.offset - self.direction) % self.period
+
+    def view(self, n_pixels=None):
+        '''Zero copy view of the first n_pixels (default all) of the rotated pattern.'''
+        if n_pixels is None:
+            n_pixels = self.n_pixels
+        i = self.offset * self.post_bytes
+        return self.pattern[i:i + 3*n_pixels]
+
+
+class TwinkleEngine:
+    # Pixels randomly switch between on and off, fading in and out rather
+    # than toggling hard. Each pixel is one state byte: bit 7 is the target
+    # (1 = fading in, 0 = fading out), bits 0-6 the current level 0-127.
+    # A frame is then
+    #   1. flip bit 7 of a random set of pixels
+    #   2. one 256 entry table lookup for every state byte to step the fades
+    #   3. one 256 entry table lookup per channel to turn states into colors
+    # all of which are vector operations (numpy or bytes.translate).
+    # The random generator is seeded, so a given seed always produces the same
+    # sequence of frames on a given backend.
+    LEVELS = 127
+
+    def __init__(self, n_pixels, rate=0.5, fade_in=0.3, fade_out=0.6, seed=None, use_numpy=True):
+        self.n_pixels = n_pixels
+        self.rate = rate                # toggles per pixel per second
+        self.fade_in = fade_in          # seconds from off to full on
+        self.fade_out = fade_out        # seconds from full on to off
+        self.use_numpy = use_numpy and numpy is not None
+        if self.use_numpy:
+            self.rng = numpy.random.default_rng(seed)
+            self.state = numpy.zeros(n_pixels, dtype=numpy.uint8)
+        else:
+            self.rng = random.Random(seed)
+            self.state = bytearray(n_pixels)
+            self.toggle_debt = 0.0      # fractional toggles carried to the next frame
+        self._steps = {}        # (levels up, levels down) per step -> (table, numpy table)
+        self._color = None
+
+    def _stepTable(self, dt):
+        '''Fade step tables for dt seconds, cached by the level steps, which jitter in dt rarely changes.'''
+        up   = min(max(1, int(round(self.LEVELS * dt / self.fade_in))), self.LEVELS)
+        down = min(max(1, int(round(self.LEVELS * dt / self.fade_out))), self.LEVELS)
+        tables = self._steps.get((up, down))
+        if tables is None:
+            table = bytes(max(0, s - down) for s in range(128)) + \
+                    bytes(min(self.LEVELS, s + up) | 0x80 for s in range(128))
+            tables = self._steps[(up, down)] = (table, numpy.frombuffer(table, dtype=numpy.uint8) if self.use_numpy else None)
+        return tables
+
+    def _colorTables(self, color):
+        if color != self._color:
+            self._color = color
+            self._tables = tuple(bytes(int(round(c * (s & 0x7f) / self.LEVELS)) for s in range(256)) for c in color)
+            if self.use_numpy:
+                self._np_tables = numpy.array([numpy.frombuffer(t, dtype=numpy.uint8) for t in self._tables]).T
+        return self._tables
+
+    def step(self, dt):
+        '''Advance dt seconds: toggle random pixels, then fade every pixel towards its target.'''
+        table, np_table = self._stepTable(dt)
+        p = self.rate * dt
+        if self.use_numpy:
+            self.state[self.rng.random(self.n_pixels) < p] ^= 0x80
+            self.state = np_table[self.state]
+        else:
+            self.toggle_debt += self.n_pixels * p
+            n_toggle = min(int(self.toggle_debt), self.n_pixels)
+            self.toggle_debt -= n_toggle
+            state = self.state
+            for i in self.rng.sample(range(self.n_pixels), n_toggle):
+                state[i] ^= 0x80
+            self.state = bytearray(state.translate(table))
+
+    def render(self, fb, color, start=0):
+        '''Write the pixels as color scaled by their level into Framebuffer fb at pixel start.'''
+        tables = self._colorTables(tuple(color))
+        stop = start + self.n_pixels
+        if fb.use_numpy and self.use_numpy:
+            fb.pixels[start:stop] = self._np_tables[self.state]
+        else:
+            state = bytes(self.state)
+            for ch in range(3):
+                fb.buf[3*start+ch:3*stop:3] = state.translate(tables[ch])
+
+
+class AnimationCache:
+    # Pre-rendered frame sequences of periodic patterns, keyed by light_style.
+    # Least recently used sequences are dropped once the frames held exceed
+    # max_bytes. The most recent sequence is always kept.
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self.entries = collections.OrderedDict()   # key: [(frame bytes, delay), ...]
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _size(frames):
+        return sum(len(frame) for frame, delay in frames)
+
+    def get(self, key, render):
+        '''Return the frames cached for key, calling render() to create them on a miss.'''
+        frames = self.entries.get(key)
+        if frames is not None:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return frames
+        self.misses += 1
+        frames = render()
+        self.entries[key] = frames
+        self.n_bytes += self._size(frames)
+        while self.n_bytes > self.max_bytes and len(self.entries) > 1:
+            old_key, old_frames = self.entries.popitem(last=False)
+            self.n_bytes -= self._size(old_frames)
+        return frames
+
+    def clear(self):
+        self.entries.clear()
+        self.n_bytes = 0
+
+    def report(self):
+        return dict(hits=self.hits, misses=self.misses, entries=len(self.entries), bytes=self.n_bytes)
+
+
+EASING_TABLE_SIZE = 1024
+
+def easingTable(curve):
+    '''Sample curve(x), x = 0..1, into a table of EASING_TABLE_SIZE values.'''
+    return tuple(curve(i / (EASING_TABLE_SIZE - 1)) for i in range(EASING_TABLE_SIZE))
+
+# Curves go from 0 at x = 0 to 1 at x = 1
+EASING = {
+    "LINEAR"      : easingTable(lambda x: x),
+    "SINE"        : easingTable(lambda x: 0.5 - 0.5 * math.cos(math.pi * x)),
+    "EXPONENTIAL" : easingTable(lambda x: (2 ** (10 * x) - 1) / 1023),
+    "STEP"        : easingTable(lambda x: 1.0 if x >= 1.0 else 0.0),
+}
+
+def registerEasing(name, curve):
+    '''Add a custom easing curve, curve(x) for x = 0..1.'''
+    EASING[name] = easingTable(curve)
+
+
+class KeyframeAnimation:
+    # A value animated between keyframes, computed from elapsed time, so it
+    # runs at the same speed whatever the frame rate.
+    #
+    # keyframes is a list of (time, value, easing), times in seconds from the
+    # start, ascending, the first at 0. easing names the EASING curve used from
+    # that keyframe to the next. The easing of the last keyframe is ignored.
+    #
+    # Example, THROB:
+    #   KeyframeAnimation([(0.0, HIGH, "SINE"), (2.0, LOW, "SINE"), (4.0, HIGH, None)])
+    def __init__(self, keyframes, loop=True, clock=time.monotonic):
+        self.times    = [k[0] for k in keyframes]
+        self.values   = [k[1] for k in keyframes]
+        self.easings  = [EASING[k[2]] if k[2] is not None else None for k in keyframes]
+        self.duration = self.times[-1]
+        self.loop     = loop
+        self.clock    = clock
+        self.start    = self.clock()
+
+    def restart(self):
+        self.start = self.clock()
+
+    def value(self, t):
+        '''Value t seconds after the start.'''
+        if self.loop and self.duration > 0:
+            t = t % self.duration
+        if t <= 0:
+            return self.values[0]
+        if t >= self.duration:
+            return self.values[-1]
+        i = bisect.bisect_right(self.times, t) - 1     # segment i is keyframe i to i+1
+        t0, t1 = self.times[i], self.times[i+1]
+        x = (t - t0) / (t1 - t0)
+        ease = self.easings[i]
+        e = ease[int(x * (EASING_TABLE_SIZE - 1))]
+        return self.values[i] + (self.values[i+1] - self.values[i]) * e
+
+    def now(self):
+        '''Value at the current time.'''
+        return self.value(self.clock() - self.start)
+
+
+class StringPipeline:
+    # Writes each LED string of a Framebuffer on its own worker thread.
+    # Shifting a frame out at WS2812 bit rate is I/O in the driver that does
+    # not hold the GIL, so a thread pool overlaps it and a frame costs the
+    # longest string instead of the sum of the strings. (Rendering is already
+    # vectorized and cheap compared to the wire time, so worker processes
+    # would only add the cost of shipping every frame between processes.)
+    #
+    # All workers wait on a barrier before writing, so every string starts
+    # shifting out the same frame at the same moment. flush() returns when
+    # every string has been written.
+    #
+    # The driver must provide copy_string_buffer(string, buf). If it has
+    # end_frame() that is called once all strings of a frame are written.
+    def __init__(self, driver, fb, leds_per_string):
+        self.driver = driver
+        self.n_strings = len(leds_per_string)
+        self.views = []     # zero copy view of each string's pixels
+        start = 0
+        for n_leds in leds_per_string:
+            self.views.append(fb.view()[3*start:3*(start+n_leds)])
+            start += n_leds
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.n_strings, thread_name_prefix="string")
+        self.barriers = {}      # barrier for each number of strings written together
+        self.start_times = [0.0] * self.n_strings
+        self.skews = collections.deque(maxlen=FrameScheduler.STATS_WINDOW)
+
+    def _writeString(self, i, barrier):
+        barrier.wait()      # common frame clock
+        self.start_times[i] = time.perf_counter()
+        self.driver.copy_string_buffer(i, self.views[i])
+
+    def flush(self, strings=None):
+        '''Write the strings numbered in strings, default all of them.'''
+        if strings is None:
+            strings = range(self.n_strings)
+        if not strings:
+            return
+        barrier = self.barriers.get(len(strings))
+        if barrier is None:
+            barrier = self.barriers[len(strings)] = threading.Barrier(len(strings))
+        futures = [self.pool.submit(self._writeString, i, barrier) for i in strings]
+        for future in futures:
+            future.result()
+        if hasattr(self.driver, "end_frame"):
+            self.driver.end_frame()
+        starts = [self.start_times[i] for i in strings]
+        self.skews.append(max(starts) - min(starts))
+
+    def report(self):
+        skews = list(self.skews)
+        return dict(strings=self.n_strings,
+                    skew_us_p50=round(1e6 * percentile(skews, 50), 1),
+                    skew_us_max=round(1e6 * max(skews, default=0.0), 1))
+
+    def close(self):
+        self.pool.shutdown()
+
+
+class FrameDelta:
+    # Tracks what changed in a Framebuffer since it was last written to the
+    # driver, so unchanged frames (STEADY refreshes, a repeated LIGHTING
+    # message) are not written at all and changed frames only write what the
+    # driver can take less of.
+    #
+    # The last written frame is kept as bytes. Comparing a whole frame is one
+    # memcmp, a few microseconds for 20k pixels. A changed frame is narrowed
+    # to one dirty span per LED string, from its first to its last changed
+    # pixel, found by binary search on the length of the equal prefix and
+    # suffix (log2(string bytes) slice compares).
+    def __init__(self, leds_per_string):
+        self.strings = []   # (start, stop) pixels of each string
+        start = 0
+        for n_leds in leds_per_string:
+            self.strings.append((start, start + n_leds))
+            start += n_leds
+        self.last = None    # bytes of the last frame written, None = unknown, write everything
+        self.flushes = 0
+        self.skipped = 0
+        self.spans   = 0
+        self.bytes   = 0
+
+    def invalidate(self):
+        '''Forget the last frame, so the next diff() reports every string changed.'''
+        self.last = None
+
+    def diff(self, fb):
+        '''List of (string, start pixel, stop pixel) dirty spans of fb since the last call, [] if fb is unchanged.'''
+        frame = fb.snapshot()
+        last, self.last = self.last, frame
+        if last is None:
+            return [(i, start, stop) for i, (start, stop) in enumerate(self.strings)]
+        if frame == last:
+            self.skipped += 1
+            return []
+        spans = []
+        for i, (start, stop) in enumerate(self.strings):
+            a, b = 3 * start, 3 * stop
+            if frame[a:b] == last[a:b]:
+                continue
+            first = a + self._equalLength(frame, last, a, b, True)
+            end = b - self._equalLength(frame, last, first, b, False)
+            spans.append((i, first // 3, (end + 2) // 3))
+        return spans
+
+    @staticmethod
+    def _equalLength(x, y, a, b, prefix):
+        '''Length of the equal prefix (or suffix) of x[a:b] and y[a:b], which are known to differ.'''
+        equal, differ = 0, b - a
+        while differ - equal > 1:
+            n = (equal + differ) // 2
+            if prefix:
+                same = x[a:a+n] == y[a:a+n]
+            else:
+                same = x[b-n:b] == y[b-n:b]
+            if same:
+                equal = n
+            else:
+                differ = n
+        return equal
+
+    def written(self, n_bytes, n_spans):
+        '''Count a write of n_bytes in n_spans spans to the driver.'''
+        self.flushes += 1
+        self.spans += n_spans
+        self.bytes += n_bytes
+
+    def report(self):
+        return dict(flushes=self.flushes, skipped=self.skipped, spans=self.spans, bytes=self.bytes)
+
+
+class PowerBudget:
+    # Keeps the estimated current of every frame inside the budget of each
+    # power supply, dimming the strings of a supply that would exceed it.
+    #
+    # Supply current is modelled from the frame's channel sums:
+    #   mA = gain * (IDLE_MA * pixels + sum over r, g, b of channel sum * MA_PER_CHANNEL[ch] / 255)
+    # one vector reduction per supply (numpy sum, or sum() of a strided
+    # bytes slice per channel). gain is calibrated against the input current
+    # measured by viThread, converted to LED_VOLTAGE current.
+    #
+    # Supplies come from the "supplies" entry of the configuration file,
+    #   "supplies" : [ {"strings" : [0, 1], "budget_ma" : 8000}, ... ]
+    # each a list of (contiguous) string numbers and its budget. Without
+    # one, frames are not limited.
+    #
+    # Dimming only reduces the channel current, never the idle current, so
+    # a supply is never dimmed below MIN_SCALE: if idle current alone is
+    # over its budget, the budget is wrong rather than the frame.
+    IDLE_MA         = 1.0                   # per pixel, all channels off
+    MA_PER_CHANNEL  = (20.0, 20.0, 20.0)    # per pixel, channel full on
+    MIN_SCALE       = 0.1                   # lowest channel scale factor when limiting
+    LED_VOLTAGE     = 5.0                   # volts, the strings' supply, modelled current is at this voltage
+    EFFICIENCY      = 0.85                  # of the supplies converting the measured input to LED_VOLTAGE
+    CAL_ALPHA       = 0.2                   # weight of each new calibration sample
+    CAL_GAIN_RANGE  = (0.5, 2.0)            # calibration is ignored outside this range
+    CAL_MIN_MA      = 100                   # estimated mA below which a sample is too noisy to calibrate
+
+    def __init__(self, supplies, leds_per_string):
+        '''supplies is a list of (list of string numbers, budget mA).'''
+        starts = [sum(leds_per_string[:i]) for i in range(len(leds_per_string) + 1)]
+        self.supplies = [(starts[min(strings)], starts[max(strings) + 1], budget_ma) for strings, budget_ma in supplies]
+        self.unlimited = []         # (start, stop) of pixels on no configured supply, copied as they are
+        covered = sorted((start, stop) for start, stop, budget_ma in self.supplies) + [(starts[-1], starts[-1])]
+        prev = 0
+        for start, stop in covered:
+            if start > prev:
+                self.unlimited.append((prev, start))
+            prev = max(prev, stop)
+        self.gain = 1.0
+        self.estimate_ma = [0.0] * len(self.supplies)   # last frame, after gain, before limiting
+        self.raw_ma = 0.0           # last frame total, before gain
+        self.n_frames  = 0
+        self.n_limited = 0
+        self.n_idle_over = 0        # frames where idle current alone was over a budget
+        self._tables = {}           # scale factor * 256 -> bytes.translate table
+
+    @classmethod
+    def fromConfig(cls, config, driver):
+        '''Budget from the "supplies" entry of the configuration, unlimited without one.'''
+        if "supplies" not in config:
+            return cls.default(driver.N_LEDS_PER_STRING)
+        return cls([(s["strings"], s["budget_ma"]) for s in config["supplies"]], driver.N_LEDS_PER_STRING)
+
+    @classmethod
+    def default(cls, leds_per_string):
+        '''No supplies, frames are copied unlimited.'''
+        return cls([], leds_per_string)
+
+    def channelSums(self, fb, start, stop):
+        '''(r, g, b) sums of pixels start..stop-1.'''
+        if fb.use_numpy:
+            return tuple(int(s) for s in fb.pixels[start:stop].sum(axis=0, dtype=numpy.uint64))
+        return tuple(sum(fb.buf[3*start+ch:3*stop:3]) for ch in range(3))
+
+    def _scale(self, src, dst, start, stop, factor):
+        f = int(factor * 256)
+        if src.use_numpy and dst.use_numpy:
+            dst.pixels[start:stop] = (src.pixels[start:stop].astype(numpy.uint16) * f) >> 8
+        else:
+            table = self._tables.get(f)
+            if table is None:
+                table = self._tables[f] = bytes((v * f) >> 8 for v in range(256))
+            dst.buf[3*start:3*stop] = bytes(src.buf[3*start:3*stop]).translate(table)
+
+    def limit(self, src, dst):
+        '''Copy Framebuffer src to dst, dimming the strings of supplies over budget.'''
+        self.n_frames += 1
+        gain = self.gain
+        raw_ma = 0.0
+        estimate_ma = []
+        for start, stop in self.unlimited:
+            dst.buf[3*start:3*stop] = src.buf[3*start:3*stop]
+        for start, stop, budget_ma in self.supplies:
+            sums = self.channelSums(src, start, stop)
+            idle_ma  = self.IDLE_MA * (stop - start)
+            color_ma = sum(s * k for s, k in zip(sums, self.MA_PER_CHANNEL)) / 255.0
+            raw_ma += idle_ma + color_ma
+            estimate_ma.append(gain * (idle_ma + color_ma))
+            if estimate_ma[-1] > budget_ma and color_ma > 0:
+                self.n_limited += 1
+                available_ma = budget_ma / gain - idle_ma
+                if available_ma <= 0:
+                    self.n_idle_over += 1
+                self._scale(src, dst, start, stop, max(available_ma / color_ma, self.MIN_SCALE))
+            else:
+                dst.buf[3*start:3*stop] = src.buf[3*start:3*stop]
+        # assigned once, calibrate() on viThread never sees a partial sum
+        self.estimate_ma = estimate_ma
+        self.raw_ma = raw_ma
+
+    def calibrate(self, measured_ma, measured_v, full_scale_ma=None):
+        '''Move gain towards the measured current / the model estimate of the last frame.
+
+        measured_ma is the input current at measured_v volts, e.g. viThread's
+        48VDC feed, converted to LED_VOLTAGE current through EFFICIENCY.
+        Samples at or above full_scale_ma, the sensor's range, are ignored.
+        '''
+        if self.raw_ma < self.CAL_MIN_MA or measured_v <= 0:
+            return
+        if full_scale_ma is not None and measured_ma >= full_scale_ma:
+            return
+        ratio = (measured_ma * measured_v * self.EFFICIENCY / self.LED_VOLTAGE) / self.raw_ma
+        if self.CAL_GAIN_RANGE[0] <= ratio <= self.CAL_GAIN_RANGE[1]:
+            self.gain += self.CAL_ALPHA * (ratio - self.gain)
+
+    def report(self):
+        return dict(gain=round(self.gain, 3), estimate_ma=[round(ma) for ma in self.estimate_ma],
+                    budget_ma=[budget_ma for start, stop, budget_ma in self.supplies],
+                    frames=self.n_frames, limited=self.n_limited, idle_over_budget=self.n_idle_over)
+
+
+class VideoSource:
+    # Frames of a 2D image or video file, memory-mapped, so playback reads
+    # one frame at a time out of the page cache and memory use does not grow
+    # with the length of the video.
+    #
+    # Formats:
+    #   PPM (P6) image, or a stream of concatenated PPM frames of one size,
+    #       e.g. ffmpeg -i in.mp4 -vf scale=160:90 -f image2pipe -c:v ppm out.ppm
+    #   headerless rgb24 frames, width and height given,
+    #       e.g. ffmpeg -i in.mp4 -vf scale=160:90 -f rawvideo -pix_fmt rgb24 out.rgb
+    #
+    # The path and parameters come from the network, anything but a regular
+    # file holding at least one frame is a ValueError (opening a FIFO would
+    # block), as are an fps that isn't a positive number and a width or
+    # height that isn't a positive int.
+    def __init__(self, path, width=None, height=None, fps=25.0):
+        self.path = path
+        if isinstance(fps, bool) or not isinstance(fps, (int, float)) or not 0 < fps < float("inf"):
+            raise ValueError("fps %r is not a positive number" % (fps,))
+        self.fps = float(fps)
+        for size in (width, height):
+            if size is not None and (isinstance(size, bool) or not isinstance(size, int) or size <= 0):
+                raise ValueError("width and height must be positive ints, not %r" % (size,))
+        if not stat.S_ISREG(os.stat(path).st_mode):
+            raise ValueError("%s is not a regular file" % path)
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if self.map[:2] == b"P6":
+                self.header, self.width, self.height = self._ppmHeader()
+            elif width and height:
+                self.header, self.width, self.height = 0, width, height
+            else:
+                raise ValueError("%s is not a PPM file, width and height are needed for raw rgb24" % path)
+            if self.width <= 0 or self.height <= 0:
+                raise ValueError("%s: %dx%d frames" % (path, self.width, self.height))
+            self.frame_size = 3 * self.width * self.height
+            self.stride = self.header + self.frame_size
+            self.n_frames = len(self.map) // self.stride
+            if self.n_frames == 0:
+                raise ValueError("%s is shorter than one %dx%d frame" % (path, self.width, self.height))
+        except ValueError:
+            self.map.close()
+            raise
+
+    def _ppmHeader(self):
+        '''(header length, width, height) of the first PPM frame.'''
+        fields = []
+        i = 2
+        while len(fields) < 3:
+            while self.map[i:i+1].isspace():
+                i += 1
+            if self.map[i:i+1] == b"#":     # comment to end of line
+                i = self.map.find(b"\n", i) + 1
+                continue
+            j = i
+            while j < len(self.map) and not self.map[j:j+1].isspace():
+                j += 1
+            fields.append(int(self.map[i:j]))      # ValueError on a truncated header
+            i = j
+        width, height, maxval = fields
+        if maxval != 255:
+            raise ValueError("%s: only 8 bit PPM is supported" % self.path)
+        return i + 1, width, height     # one whitespace byte ends the header
+
+    def __len__(self):
+        return self.n_frames
+
+    def frame(self, i):
+        '''Zero copy view of the r, g, b bytes of frame i (wrapping), rows top to bottom.'''
+        start = (i % self.n_frames) * self.stride + self.header
+        return memoryview(self.map)[start:start+self.frame_size]
+
+    def close(self):
+        self.map.close()
+
+
+class ImageMapper:
+    # Samples 2D frames onto the LED pixels through a precomputed sampling
+    # index: the byte offset in the frame of every pixel's r, g, b, from each
+    # pixel's (x, y) position on the roof. Sampling a frame is then one
+    # gather, numpy take or an operator.itemgetter of all offsets.
+    def __init__(self, positions, width, height, use_numpy=True):
+        '''positions is an (x, y) per pixel, 0.0 - 1.0, left to right and top to bottom of the image.'''
+        self.width = width
+        self.height = height
+        self.use_numpy = use_numpy and numpy is not None
+        offsets = []
+        for x, y in positions:
+            col = min(int(x * width), width - 1)
+            row = min(int(y * height), height - 1)
+            offsets.append(3 * (row * width + col))
+        if self.use_numpy:
+            self.np_index = numpy.array(offsets, dtype=numpy.intp) // 3
+        else:
+            self.getter = operator.itemgetter(*[o + ch for o in offsets for ch in range(3)])
+
+    def render(self, frame, fb):
+        '''Sample frame, width x height r, g, b bytes, into Framebuffer fb.'''
+        if self.use_numpy and fb.use_numpy:
+            pixels = numpy.frombuffer(frame, dtype=numpy.uint8).reshape(-1, 3)
+            numpy.take(pixels, self.np_index, axis=0, out=fb.pixels)
+        else:
+            fb.buf[:] = bytes(self.getter(frame))
+
+
+class PostGeometry:
+    # Maps (post, orientation) to the slice of pixels lighting it, computed
+    # once at startup so per-post updates are slice assignments.
+    #
+    # The roof layout comes from the "layout" entry of the configuration file,
+    # one list per LED string, in string order, of the (post, orientation)
+    # blocks along the string from its data input:
+    #   {
+    #     "leds_per_block" : 4,                                 optional, default N_LEDS_PER_POST
+    #     "layout" : [ [[1, "N"], [1, "S"], [2, "N"], ...],     string 0
+    #                  [[9, "N"], ...] ]                        string 1
+    #   }
+    # Without a layout, each string is divided into blocks of N_LEDS_PER_POST
+    # pixels, posts numbered from 1 across all strings, orientation ANY.
+    # Lookups for an orientation a post doesn't have fall back to ANY.
+    #
+    # Where each post is on the roof, for mapping images onto the posts, is
+    # the optional "post_positions" entry, {"1" : [x, y], ...} in any units.
+    # Without it the posts are spaced along a horizontal line.
+    ANY = "ANY"
+
+    def __init__(self, blocks, n_pixels):
+        '''blocks is a list of (post, orientation, start pixel, stop pixel).'''
+        self.blocks = sorted(blocks, key=lambda b: b[2])
+        self.n_pixels = n_pixels
+        self.index = dict(((post, orientation), (start, stop)) for post, orientation, start, stop in self.blocks)
+        self._positions = {}
+        self.post_positions = None  # {post : (x, y)}, from the configuration file
+
+    @classmethod
+    def fromLayout(cls, layout, leds_per_string, leds_per_block):
+        blocks = []
+        string_start = 0
+        for string, string_layout in enumerate(layout):
+            start = string_start
+            for post, orientation in string_layout:
+                blocks.append((int(post), orientation, start, start + leds_per_block))
+                start += leds_per_block
+            if start > string_start + leds_per_string[string]:
+                raise ValueError("layout of string %d needs %d LEDs, the string has %d" % (string, start - string_start, leds_per_string[string]))
+            string_start += leds_per_string[string]
+        return cls(blocks, sum(leds_per_string))
+
+    @classmethod
+    def default(cls, leds_per_string, leds_per_post):
+        layout = []
+        post = 1
+        for n_leds in leds_per_string:
+            layout.append([(post + i, cls.ANY) for i in range(n_leds // leds_per_post)])
+            post += n_leds // leds_per_post
+        return cls.fromLayout(layout, leds_per_string, leds_per_post)
+
+    @classmethod
+    def fromConfig(cls, config, driver):
+        '''Geometry from the configuration's layout, or the default without one.'''
+        if "layout" not in config:
+            geometry = cls.default(driver.N_LEDS_PER_STRING, driver.N_LEDS_PER_POST)
+        else:
+            geometry = cls.fromLayout(config["layout"], driver.N_LEDS_PER_STRING, config.get("leds_per_block", driver.N_LEDS_PER_POST))
+        if "post_positions" in config:
+            geometry.post_positions = dict((int(post), tuple(xy)) for post, xy in config["post_positions"].items())
+        return geometry
+
+    def slice(self, post, orientation=ANY):
+        '''(start, stop) pixels of a post. Raises KeyError for an unknown post.'''
+        key = (post, orientation)
+        if key not in self.index:
+            key = (post, self.ANY)
+        return self.index[key]
+
+    def palettePositions(self, cycles=1.0):
+        '''Position 0.0 - 1.0 in a palette of every pixel, spreading the palette cycles times along the posts.
+
+        Every pixel of a post gets the same position, pixels between posts
+        get the position of the post before them.
+        '''
+        positions = self._positions.get(cycles)
+        if positions is None:
+            positions = [0.0] * self.n_pixels
+            n_blocks = max(len(self.blocks), 1)
+            for i, (post, orientation, start, stop) in enumerate(self.blocks):
+                next_start = self.blocks[i+1][2] if i + 1 < len(self.blocks) else self.n_pixels
+                positions[start:next_start] = [(i * cycles / n_blocks) % 1.0] * (next_start - start)
+            self._positions[cycles] = positions
+        return positions
+
+    def imagePositions(self):
+        '''(x, y) 0.0 - 1.0 position of every pixel in an image covering all the posts.
+
+        Positions come from post_positions scaled to fit the image, keeping
+        the aspect ratio, or are spread along a horizontal line through the
+        middle. Pixels between posts get the position of the post before them.
+        '''
+        posts = sorted(set(post for post, orientation, start, stop in self.blocks))
+        if self.post_positions:
+            xs = [xy[0] for xy in self.post_positions.values()]
+            ys = [xy[1] for xy in self.post_positions.values()]
+            span = max(max(xs) - min(xs), max(ys) - min(ys)) or 1.0
+            where = dict((post, ((xy[0] - min(xs)) / span, (xy[1] - min(ys)) / span)) for post, xy in self.post_positions.items())
+        else:
+            where = dict((post, ((i + 0.5) / len(posts), 0.5)) for i, post in enumerate(posts))
+        positions = [(0.0, 0.0)] * self.n_pixels
+        for i, (post, orientation, start, stop) in enumerate(self.blocks):
+            next_start = self.blocks[i+1][2] if i + 1 < len(self.blocks) else self.n_pixels
+            positions[start:next_start] = [where.get(post, (0.0, 0.0))] * (next_start - start)
+        return positions
+
+
+# LIGHTING_BATCH packed entry: post, orientation (ASCII, NUL padded), r, g, b, brightness 0 - 255
+LIGHTING_ENTRY = struct.Struct("<H4s3BB")
+
+def packLighting(entries):
+    '''Pack (post, orientation, (r, g, b), brightness 0.0 - 1.0) entries for a LIGHTING_BATCH message.
+
+    ValueError for an orientation longer than 4 bytes, which the entry can't hold.
+    '''
+    out = bytearray(LIGHTING_ENTRY.size * len(entries))
+    for i, (post, orientation, color, brightness) in enumerate(entries):
+        orientation = orientation.encode()
+        if len(orientation) > 4:
+            raise ValueError("orientation %r longer than 4 bytes" % orientation)
+        LIGHTING_ENTRY.pack_into(out, i * LIGHTING_ENTRY.size, post, orientation, color[0], color[1], color[2], int(round(brightness * 255)))
+    return bytes(out)
+
+def unpackLighting(data):
+    '''Generator of (post, orientation, (r, g, b), brightness 0.0 - 1.0) from packLighting() bytes.'''
+    for post, orientation, r, g, b, brightness in LIGHTING_ENTRY.iter_unpack(data):
+        yield post, orientation.rstrip(b"\0").decode(), (r, g, b), brightness / 255
+
+
+class PatternLayer:
+    # Render state of one light_style: the frame it renders into and where
+    # its animations are up to. Two layers are live during a crossfade.
+    def __init__(self, fb, style=None):
+        self.fb      = fb
+        self.style   = style    # last light_style rendered
+        self.anim    = None     # frames of the periodic pattern being played, [(frame bytes, delay), ...]
+        self.anim_i  = 0        # next frame of self.anim to show
+        self.throb   = None     # KeyframeAnimation of the THROB intensity, created when THROB starts
+        self.twinkle = None     # TwinkleEngine, created when TWINKLE starts
+        self.twinkle_t = None   # clock() of the last TWINKLE step
+        self.color   = None     # THROB and TWINKLE color, a palette's random pick is kept, not redrawn every frame
+        self.color_cycle = None # THROB cycle self.color was picked for
+        self.due     = 0.0      # time.monotonic() when the next frame of this layer is due
+
+
+class FencepostRenderer:
+    # Renders the fencepost light_style messages into a Framebuffer.
+    # driver is the LED string driver module (fencepost_neopixel_driver or
+    # anything with its interface), used for its geometry and color constants
+    # and as the target of flush(). Timing is left to the caller: each render
+    # returns the delay until the next frame is due.
+    #
+    # A new DISPLAY style crossfades from the old one over CROSSFADE_TIME.
+    # While the fade runs both styles render into their own frames, each only
+    # when its own next frame is due, and are blended into the output frame.
+    STROBE_ON_TIME      = 0.010     # 10 mS
+    STROBE_INTERVAL     = 1.0       # flash every 1 second
+    THROB_INTERVAL      = 4.0       # seconds from dark to set intensity and back to dark
+    THROB_EASING        = "SINE"    # EASING curve for the intensity ramps
+    MARCH_POSTS         = (2, 2)    # MARCH pattern is 2 posts on, 2 posts off, stepping 1 post per interval
+    MARCH_DIRECTION     = 1         # 1 = march towards the end of the strings, -1 = towards the start
+    MARCH_INTERVAL      = 1.0       # post pattern marches every second
+    TWINKLE_RATE        = 0.5       # times per second each pixel changes between on and off
+    TWINKLE_FADE_IN     = 0.3       # sec, off to on
+    TWINKLE_FADE_OUT    = 0.6       # sec, on to off
+    TWINKLE_SEED        = None      # set to an int for a reproducible twinkle sequence
+    CROSSFADE_TIME      = 0.5       # sec, 0 = hard cut between DISPLAY styles
+    GAMMA               = 1.0       # 1.0 = linear intensity scaling, same as npdrvr.set_intensity()
+    CALIBRATION         = (1.0, 1.0, 1.0)   # per channel (r, g, b) gain to balance the LED colors
+    PATTERNS            = ("STEADY", "STROBE", "THROB", "MARCH", "TWINKLE")
+    PERIODIC_PATTERNS   = ("STEADY", "STROBE", "MARCH")     # rendered once, then replayed from cache
+    ANIMATION_CACHE_SIZE = 8 * 1024 * 1024  # bytes of pre-rendered frames kept
+    PARALLEL_STRINGS    = True      # write strings in parallel when the driver supports it
+    DELTA_FLUSH         = True      # skip unchanged frames and strings, write changed spans when the driver supports it
+    ENCODE_FRAMES       = False     # send rl_frame_codec encoded frames, for DMs decoding the data line, when the driver supports it
+    PALETTES            = {         # palette colors, gradient stops (position, (r, g, b)), ending where they start to scroll seamlessly
+        "RAINBOW" : [(0.0, (255, 0, 0)), (1/3, (0, 255, 0)), (2/3, (0, 0, 255)), (1.0, (255, 0, 0))],
+        "FIRE"    : [(0.0, (40, 0, 0)), (0.3, (255, 30, 0)), (0.5, (255, 140, 0)), (0.6, (255, 220, 60)), (0.8, (255, 60, 0)), (1.0, (40, 0, 0))],
+        "OCEAN"   : [(0.0, (0, 10, 60)), (0.35, (0, 90, 160)), (0.5, (0, 200, 200)), (0.6, (120, 230, 255)), (0.75, (0, 90, 160)), (1.0, (0, 10, 60))],
+    }
+    PALETTE_SIZE        = 1024      # entries per palette table
+    PALETTE_CYCLES      = 1.0       # times a palette repeats along all the posts
+    PALETTE_SPEED       = 0.1       # palette lengths per second a STEADY palette color scrolls
+    DITHER              = False     # temporal dithering of THROB, smooth low intensity fades at a high frame rate
+    DITHER_FPS          = 200       # THROB frame rate while dithering, limited by the driver's wire_time() if it has one
+
+    def __init__(self, driver, frame_period, geometry=None, palettes=None, power=None, clock=time.monotonic):
+        '''palettes is a dictionary of custom Palettes, e.g. from Palette.fromConfig(), added to PALETTES.'''
+        self.driver = driver
+        self.geometry = geometry or PostGeometry.default(driver.N_LEDS_PER_STRING, driver.N_LEDS_PER_POST)
+        self.power = power or PowerBudget.default(driver.N_LEDS_PER_STRING)
+        self.palettes = dict((name, Palette(stops, self.PALETTE_SIZE)) for name, stops in self.PALETTES.items())
+        self.palettes.update(palettes or {})
+        self.palette_index = {}     # palette size -> Palette.index() of the geometry
+        self.scaled_palettes = collections.OrderedDict()    # (name, intensity) -> palette scaled to intensity
+        self.frame_period = frame_period
+        self.clock = clock
+        self.STD_COLOR     = { "RED" : driver.COLOR_RED, "GREEN" : driver.COLOR_GREEN, "BLUE" : driver.COLOR_BLUE, "WHITE" : driver.COLOR_WHITE }
+        self.STD_INTENSITY = { "LOW" : driver.INTENSITY_LOW, "MEDIUM" : driver.INTENSITY_MEDIUM, "HIGH" : driver.INTENSITY_HIGH }
+        self.fb = Framebuffer(sum(driver.N_LEDS_PER_STRING))    # output frame, pixel state of all strings
+        self.out = Framebuffer(len(self.fb))    # fb within the power budget, as written to the driver
+        self.anim_cache = AnimationCache(self.ANIMATION_CACHE_SIZE)
+        self.layer      = PatternLayer(self.fb)     # current style
+        self.outgoing   = None  # PatternLayer fading out during a crossfade
+        self.fade_start = 0.0
+        self.blend_times = collections.deque(maxlen=FrameScheduler.STATS_WINDOW)
+        self.dither     = TemporalDither(len(self.fb))
+        self.dither_period = 1.0 / self.DITHER_FPS
+        if hasattr(driver, "wire_time"):
+            self.dither_period = max(self.dither_period, driver.wire_time())
+        self.video      = None  # VideoSource playing
+        self.video_start = 0.0
+        self.mapper     = None  # ImageMapper for the video's frame size
+        self.pipeline   = None  # StringPipeline, when strings are written in parallel
+        if self.PARALLEL_STRINGS and len(driver.N_LEDS_PER_STRING) > 1 and hasattr(driver, "copy_string_buffer"):
+            self.pipeline = StringPipeline(driver, self.out, driver.N_LEDS_PER_STRING)
+        self.delta = FrameDelta(driver.N_LEDS_PER_STRING)
+
+    def report(self):
+        blend = list(self.blend_times)
+        report = dict(animation_cache=self.anim_cache.report(),
+                      crossfade=dict(active=self.outgoing is not None,
+                                     blend_us_p50=round(1e6 * percentile(blend, 50), 1),
+                                     blend_us_p99=round(1e6 * percentile(blend, 99), 1)),
+                      flush=self.delta.report(),
+                      power=self.power.report())
+        if self.pipeline is not None:
+            report["pipeline"] = self.pipeline.report()
+        return report
+
+    def restart(self, style=None):
+        '''Call when a new light_style arrives, so animations start from the beginning.
+
+        A DISPLAY style replacing a DISPLAY style starts a crossfade.
+        '''
+        self._closeVideo()
+        old = self.layer
+        if (self.CROSSFADE_TIME > 0 and style is not None and style[0] == "DISPLAY"
+                and old.style is not None and old.style[0] == "DISPLAY"):
+            # the outgoing style continues in a copy of the current output frame
+            old.fb = Framebuffer(len(self.fb))
+            old.fb.copyFrom(self.fb.view())
+            self.outgoing = old
+            self.layer = PatternLayer(Framebuffer(len(self.fb)))
+            self.fade_start = self.clock()
+        else:
+            self._endCrossfade()
+            self.layer = PatternLayer(self.fb)
+
+    def _endCrossfade(self):
+        if self.outgoing is not None:
+            self.outgoing = None
+            self.fb.copyFrom(self.layer.fb.view())
+            self.layer.fb = self.fb
+
+    def _closeVideo(self):
+        if self.video is not None:
+            self.video.close()
+            self.video = None
+
+    def close(self):
+        self._closeVideo()
+        if self.pipeline is not None:
+            self.pipeline.close()
+
+    def flush(self):
+        '''Write the frame to the driver.
+
+        The frame is first dimmed where needed to stay inside the power budget.
+        With DELTA_FLUSH an unchanged frame is not written, the pipeline only
+        writes the strings that changed and a driver with copy_buffer_spans()
+        only gets the dirty spans.
+        '''
+        self.power.limit(self.fb, self.out)
+        if not self.DELTA_FLUSH:
+            spans = [(i, start, stop) for i, (start, stop) in enumerate(self.delta.strings)]
+        else:
+            spans = self.delta.diff(self.out)
+            if not spans:
+                return
+        if self.ENCODE_FRAMES and hasattr(self.driver, "copy_encoded_frame"):
+            data = rl_frame_codec.encodeFrame(self.out.view())
+            self.driver.copy_encoded_frame(data)
+            n_bytes = len(data)
+        elif self.pipeline is not None:
+            self.pipeline.flush([i for i, start, stop in spans])
+            n_bytes = sum(3 * (self.delta.strings[i][1] - self.delta.strings[i][0]) for i, start, stop in spans)
+        elif self.DELTA_FLUSH and hasattr(self.driver, "copy_buffer_spans"):
+            self.driver.copy_buffer_spans(self.out.view(), [(start, stop) for i, start, stop in spans])
+            n_bytes = sum(3 * (stop - start) for i, start, stop in spans)
+        else:
+            self.out.flush(self.driver)
+            n_bytes = 3 * len(self.out)
+        self.delta.written(n_bytes, len(spans))
+
+    def _colorLookup(self, color):
+        if color in self.STD_COLOR:
+            pixel_color = self.STD_COLOR[color]
+        elif color in self.palettes:      # one random color of the palette
+            palette = self.palettes[color]
+            pixel_color = palette.color(random.randrange(palette.size))
+        else:
+            pixel_color = self.driver.COLOR_WHITE
+        return pixel_color
+
+    def _intensityLookup(self, intensity):
+        return self.STD_INTENSITY.get(intensity, self.driver.INTENSITY_LOW)
+
+    def _setIntensity(self, color, intensity):
+        '''Scale color to intensity through the cached gamma/calibration lookup table.'''
+        return IntensityLUT.get(intensity, self.GAMMA, self.CALIBRATION).color(color)
+
+    def _renderPalette(self, fb, name, intensity):
+        '''Render palette name along the posts at intensity, scrolled PALETTE_SPEED palette lengths per second.'''
+        key = (name, intensity)
+        palette = self.scaled_palettes.get(key)
+        if palette is None:
+            palette = self.palettes[name].scaled(IntensityLUT.get(intensity, self.GAMMA, self.CALIBRATION))
+            self.scaled_palettes[key] = palette
+            if len(self.scaled_palettes) > IntensityLUT.CACHE_SIZE:
+                self.scaled_palettes.popitem(last=False)
+        index = self.palette_index.get(palette.size)
+        if index is None:
+            index = self.palette_index[palette.size] = palette.index(self.geometry.palettePositions(self.PALETTE_CYCLES))
+        palette.render(fb, index, (self.clock() * self.PALETTE_SPEED) % 1.0)
+
+    def _renderAnimation(self, fb, style):
+        '''Render one period of a periodic pattern, using fb as scratch. Returns [(frame bytes, delay), ...].'''
+        color     = self._colorLookup(style[1])
+        intensity = self._intensityLookup(style[2])
+        pattern   = style[3]
+        frames    = []
+
+        if   pattern == "STEADY":
+            fb.fill(self._setIntensity(color, intensity))
+            frames.append((fb.snapshot(), self.frame_period))
+
+        elif pattern == "STROBE":
+            fb.fill(self._setIntensity(color, intensity))
+            frames.append((fb.snapshot(), self.STROBE_ON_TIME))
+            fb.fill(self._setIntensity(color, self.driver.INTENSITY_OFF))
+            frames.append((fb.snapshot(), self.STROBE_INTERVAL))
+
+        elif pattern == "MARCH":
+            march = MarchPattern(max(self.driver.N_LEDS_PER_STRING), self.driver.N_LEDS_PER_POST, self._setIntensity(color, intensity),
+                                 *self.MARCH_POSTS, direction=self.MARCH_DIRECTION)
+            for step in range(march.period):
+                i_start = 0
+                for n_leds in self.driver.N_LEDS_PER_STRING:    # every string shows the same march
+                    fb.copyFrom(march.view(n_leds), i_start)
+                    i_start += n_leds
+                frames.append((fb.snapshot(), self.MARCH_INTERVAL))
+                march.step()    # advance the pattern one post
+
+        return frames
+
+    def _nextAnimationFrame(self, layer, style):
+        '''Render the next frame of a periodic pattern, rendering the period or fetching it from cache as needed.'''
+        if layer.anim is None or layer.anim_i >= len(layer.anim):
+            if style[1] in self.palettes:   # new random color every period, not cacheable
+                layer.anim = self._renderAnimation(layer.fb, style)
+            else:
+                layer.anim = self.anim_cache.get(style, lambda: self._renderAnimation(layer.fb, style))
+            layer.anim_i = 0
+        frame, delay = layer.anim[layer.anim_i]
+        layer.anim_i += 1
+        layer.fb.copyFrom(frame)
+        return delay
+
+    def _renderLayer(self, layer, style):
+        '''Render the next frame of style into layer.fb. Returns the delay to the following frame, None if the pattern is not recognized.'''
+
+        # display color is one of (RED, GREEN, BLUE, WHITE) or a palette (RAINBOW, FIRE, OCEAN, custom)
+        # display intensity is one of (LOW, MEDIUM, HIGH)
+        # display pattern is one of (STEADY, STROBE, THROB, MARCH, TWINKLE)
+        pattern = style[3]
+        layer.style = style
+
+        if pattern == "STEADY" and style[1] in self.palettes:     # palette scrolling along the posts
+            self._renderPalette(layer.fb, style[1], self._intensityLookup(style[2]))
+            return self.frame_period
+
+        if pattern in self.PERIODIC_PATTERNS:
+            return self._nextAnimationFrame(layer, style)
+
+        intensity = self._intensityLookup(style[2])
+
+        if pattern == "THROB":
+            # down from set intensity to INTENSITY_LOW and back up, computed from elapsed time
+            if layer.throb is None:
+                layer.throb = KeyframeAnimation([(0.0, intensity, self.THROB_EASING),
+                                                 (self.THROB_INTERVAL / 2, self.driver.INTENSITY_LOW, self.THROB_EASING),
+                                                 (self.THROB_INTERVAL, intensity, None)], clock=self.clock)
+            # one color per throb, a palette picks the next at the dimmest point
+            cycle = int((layer.throb.clock() - layer.throb.start) / self.THROB_INTERVAL + 0.5)
+            if cycle != layer.color_cycle:
+                layer.color = self._colorLookup(style[1])
+                layer.color_cycle = cycle
+            color = layer.color
+            if self.DITHER and layer.fb is self.fb:     # not while crossfading
+                self.dither.fill(IntensityLUT.scaleColor(color, layer.throb.now(), self.GAMMA, self.CALIBRATION, TemporalDither.MAX_LEVEL))
+                self.dither.render(layer.fb)
+                return self.dither_period
+            layer.fb.fill(IntensityLUT.scaleColor(color, layer.throb.now(), self.GAMMA, self.CALIBRATION))
+            return self.frame_period
+
+        if pattern == "TWINKLE":
+            if layer.twinkle is None:
+                layer.twinkle = TwinkleEngine(len(layer.fb), self.TWINKLE_RATE, self.TWINKLE_FADE_IN, self.TWINKLE_FADE_OUT, self.TWINKLE_SEED)
+                layer.color = self._colorLookup(style[1])   # a palette's pick lasts as long as the layer
+            # fades need every frame, stepped by the time since the last one, late or not
+            now = self.clock()
+            layer.twinkle.step(self.frame_period if layer.twinkle_t is None else now - layer.twinkle_t)
+            layer.twinkle_t = now
+            layer.twinkle.render(layer.fb, self._setIntensity(layer.color, intensity))
+            return self.frame_period
+
+        return None
+
+    def renderDisplay(self, style):
+        '''Render the next frame of ("DISPLAY", COLOR, INTENSITY, PATTERN).
+
+        Returns seconds until the following frame, or None if the pattern is not recognized.
+        '''
+        style = tuple(style)
+        now = self.clock()
+
+        if self.outgoing is None:
+            delay = self._renderLayer(self.layer, style)
+            if delay is not None:
+                self.layer.due = now + delay
+            return delay
+
+        if style[3] not in self.PATTERNS:
+            self._endCrossfade()
+            return None
+
+        # crossfade, render each layer when its next frame is due then blend
+        for layer in (self.outgoing, self.layer):
+            if now >= layer.due:
+                layer.due = now + self._renderLayer(layer, layer.style if layer is self.outgoing else style)
+        x = (now - self.fade_start) / self.CROSSFADE_TIME
+        if x >= 1.0:
+            self._endCrossfade()
+            return max(self.layer.due - now, 0.0)
+        t_start = time.perf_counter()
+        self.fb.blend(self.outgoing.fb, self.layer.fb, x)
+        self.blend_times.append(time.perf_counter() - t_start)
+        return min(self.frame_period, self.outgoing.due - now, self.layer.due - now)
+
+    def renderVideo(self, style):
+        '''Render the frame due now of ("VIDEO", FILE, INTENSITY[, WIDTH, HEIGHT, FPS]), looping.
+
+        WIDTH and HEIGHT are needed for raw rgb24 files. Returns seconds until
+        the following frame. Raises OSError or ValueError for a file that
+        can't be played or a WIDTH, HEIGHT or FPS out of range.
+        '''
+        if self.video is None:
+            self.video = VideoSource(style[1], *style[3:6])
+            self.video_start = self.clock()
+            if self.mapper is None or (self.mapper.width, self.mapper.height) != (self.video.width, self.video.height):
+                self.mapper = ImageMapper(self.geometry.imagePositions(), self.video.width, self.video.height)
+        self.layer.style = None
+        i = int((self.clock() - self.video_start) * self.video.fps)    # late frames are skipped, not slowed down
+        self.mapper.render(self.video.frame(i), self.fb)
+        IntensityLUT.get(self._intensityLookup(style[2]), self.GAMMA, self.CALIBRATION).apply(self.fb)
+        return 1.0 / self.video.fps
+
+    def _postColor(self, color, intensity):
+        '''color, (r, g, b) 0 - 255 from a LIGHTING message, scaled to intensity. ValueError or TypeError if either is malformed.'''
+        if len(color) != 3 or not all(0 <= c <= 255 for c in color):
+            raise ValueError("color %r is not (r, g, b) 0 - 255" % (color,))
+        return self._setIntensity(color, intensity)
+
+    def renderLighting(self, post, orientation, color, intensity):
+        '''Set the pixels of one post.
+
+        Raises KeyError for a post not in the geometry, ValueError or
+        TypeError for a malformed color or intensity, leaving the frame untouched.
+        '''
+        start, stop = self.geometry.slice(post, orientation)
+        pixel_color = self._postColor(color, intensity)
+        self.layer.style = None     # the frame is no longer a DISPLAY style to fade from
+        self.fb.setRange(start, stop, pixel_color)
+
+    def renderLightingBatch(self, entries):
+        '''Set many posts in one frame update, returns the number of posts set.
+
+        entries is a list of (post, orientation, color, intensity) or packLighting() bytes.
+        Every entry is checked before any pixel changes, so on an unknown post
+        (KeyError) or a malformed entry (ValueError, TypeError) the frame is
+        left untouched.
+        '''
+        if isinstance(entries, (bytes, bytearray, memoryview)):
+            entries = unpackLighting(entries)
+        scaled = {}     # (color, intensity) -> pixel color, a scene repeats a few colors over many posts
+        spans = []
+        for post, orientation, color, intensity in entries:
+            key = (tuple(color), intensity)
+            pixel_color = scaled.get(key)
+            if pixel_color is None:
+                pixel_color = scaled[key] = self._postColor(*key)
+            spans.append(self.geometry.slice(int(post), orientation) + (pixel_color,))
+        self.layer.style = None
+        for start, stop, pixel_color in spans:
+            self.fb.setRange(start, stop, pixel_color)
+        return len(spans)
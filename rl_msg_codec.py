@@ -0,0 +1,262 @@
+#
+
+"""
+
+Binary encoding of the control messages (MSG_TYPES) for the framed protocol
+in rl_net, replacing pickle: payloads are 2 - 4 times smaller and decoding
+can't run code sent by whoever connects to the port.
+
+Speed is not a goal. Schemas of fixed size numbers only are one struct call
+and about as fast as pickle, the others are pure Python and 2 - 4 times
+slower than pickle (C on CPython), a few microseconds per message, small
+next to the system calls of sending it.
+
+Every message type has a schema, the list of its fields after the type name
+(the type itself is in the frame header). Responses have a schema keyed by
+the type of the request they answer. Runs of fixed size fields are
+precompiled into one struct.Struct, decoding works on a memoryview of the
+receive buffer without copying it, BLOB fields decode to memoryviews into it.
+
+Field kinds
+    U16, F32, F64   fixed size numbers, network byte order
+    COLOR           (r, g, b), 3 x u8
+    STR             u8 length, utf-8
+    BLOB            u32 length, bytes
+    JSON            u32 length, utf-8 JSON (dictionaries, e.g. health status)
+    STRLIST         u16 count, STR each
+    PAIRS           u16 count, (f64, f64) each
+
+encodeMessage() and encodeResponse() return None for a message that doesn't
+fit its schema (or has none), the caller then falls back to pickle.
+
+"""
+
+import json
+import struct
+
+from rl_lighting import packLighting
+
+
+_FIXED = {
+    "U16"   : "H",
+    "F32"   : "f",
+    "F64"   : "d",
+    "COLOR" : "3B",
+}
+
+_LENGTH8  = struct.Struct("!B")
+_LENGTH16 = struct.Struct("!H")
+_LENGTH32 = struct.Struct("!I")
+_PAIR     = struct.Struct("!dd")
+
+# fields of each message after the type name
+SCHEMAS = {
+    "DISPLAY"        : ("STR", "STR", "STR"),           # color, intensity, pattern
+    "LIGHTING"       : ("U16", "STR", "COLOR", "F32"),  # post, orientation, (r, g, b), brightness
+    "LIGHTING_BATCH" : ("BLOB",),                       # rl_lighting.packLighting() entries
+    "VIDEO"          : ("STR", "STR"),                  # file, intensity
+    "VI_QUERY"       : (),
+    "VI_HISTORY"     : (),
+    "FLOW_QUERY"     : (),
+    "FLOW_HISTORY"   : (),
+    "TEMP_QUERY"     : (),
+    "SOUND"          : (),
+    "PLAY_AUDIO"     : ("STR",),                        # file
+    "HEALTH_NOTICE"  : ("JSON",),                       # health status dictionary
+}
+
+# responses, by the type of the request answered
+# a tuple of fields is a tuple response, a single kind is the whole response
+RESPONSE_SCHEMAS = {
+    "VI_QUERY"       : ("F64", "F64"),                  # (vin, cur)
+    "VI_HISTORY"     : "PAIRS",                         # [(vin, cur), ...]
+    "FLOW_QUERY"     : ("F64", "F64", "STR"),           # (gpm, gal, zone)
+    "FLOW_HISTORY"   : "STRLIST",                       # flow record lines
+    "TEMP_QUERY"     : ("F64", "F64", "F64"),           # (indoor, outdoor, discharge)
+}
+
+
+def _strEncoder(out, value):
+    data = value.encode()
+    out.append(len(data))
+    out += data
+
+def _strDecoder(view, i, values):
+    n = view[i]
+    values.append(str(view[i+1:i+1+n], "utf-8"))
+    return i + 1 + n
+
+def _blobEncoder(out, value):
+    out += _LENGTH32.pack(len(value))
+    out += value
+
+def _blobDecoder(view, i, values):
+    n = _LENGTH32.unpack_from(view, i)[0]
+    values.append(view[i+4:i+4+n])
+    return i + 4 + n
+
+def _jsonEncoder(out, value):
+    _blobEncoder(out, json.dumps(value, separators=(",", ":")).encode())
+
+def _jsonDecoder(view, i, values):
+    n = _LENGTH32.unpack_from(view, i)[0]
+    values.append(json.loads(str(view[i+4:i+4+n], "utf-8")))
+    return i + 4 + n
+
+def _strlistEncoder(out, value):
+    out += _LENGTH16.pack(len(value))
+    for s in value:
+        _strEncoder(out, s)
+
+def _strlistDecoder(view, i, values):
+    count = _LENGTH16.unpack_from(view, i)[0]
+    strings = []
+    i += 2
+    for k in range(count):
+        i = _strDecoder(view, i, strings)
+    values.append(strings)
+    return i
+
+def _pairsEncoder(out, value):
+    out += _LENGTH16.pack(len(value))
+    for pair in value:
+        out += _PAIR.pack(*pair)
+
+def _pairsDecoder(view, i, values):
+    count = _LENGTH16.unpack_from(view, i)[0]
+    i += 2
+    values.append(list(_PAIR.iter_unpack(view[i:i+_PAIR.size*count])))
+    return i + _PAIR.size * count
+
+_VARIABLE = {
+    "STR"     : (_strEncoder, _strDecoder),
+    "BLOB"    : (_blobEncoder, _blobDecoder),
+    "JSON"    : (_jsonEncoder, _jsonDecoder),
+    "STRLIST" : (_strlistEncoder, _strlistDecoder),
+    "PAIRS"   : (_pairsEncoder, _pairsDecoder),
+}
+
+
+def _fixedCoders(kinds):
+    '''(encoder, decoder) for a run of fixed size fields, packed with one precompiled struct.Struct.'''
+    fixed = struct.Struct("!" + "".join(_FIXED[kind] for kind in kinds))
+    if "COLOR" not in kinds:
+        def encoder(out, *values):
+            out += fixed.pack(*values)
+
+        def decoder(view, i, values):
+            values.extend(fixed.unpack_from(view, i))
+            return i + fixed.size
+        return encoder, decoder
+
+    def encoder(out, *values):
+        args = []
+        for kind, value in zip(kinds, values):
+            if kind == "COLOR":
+                args.extend(value)
+            else:
+                args.append(value)
+        out += fixed.pack(*args)
+
+    def decoder(view, i, values):
+        unpacked = fixed.unpack_from(view, i)
+        j = 0
+        for kind in kinds:
+            if kind == "COLOR":
+                values.append(unpacked[j:j+3])
+                j += 3
+            else:
+                values.append(unpacked[j])
+                j += 1
+        return i + fixed.size
+    return encoder, decoder
+
+
+class _Plan:
+    # A schema compiled into (encoder, decoder, number of values) steps, one
+    # per run of fixed size fields or per variable size field. A schema of
+    # fixed size numbers only (most queries and their responses) is one
+    # precompiled struct.Struct, packed and unpacked in a single call.
+    def __init__(self, fields):
+        self.n_values = len(fields)
+        self.fixed = None
+        if all(kind in _FIXED and kind != "COLOR" for kind in fields):
+            self.fixed = struct.Struct("!" + "".join(_FIXED[kind] for kind in fields))
+        self.steps = []
+        kinds = []
+        for kind in tuple(fields) + (None,):
+            if kind in _FIXED:
+                kinds.append(kind)
+                continue
+            if kinds:
+                self.steps.append(_fixedCoders(kinds) + (len(kinds),))
+                kinds = []
+            if kind is not None:
+                self.steps.append(_VARIABLE[kind] + (1,))
+
+    def encode(self, values):
+        if len(values) != self.n_values:
+            raise ValueError("%d values for %d fields" % (len(values), self.n_values))
+        if self.fixed is not None:
+            return self.fixed.pack(*values)
+        out = bytearray()
+        i = 0
+        for encoder, decoder, n in self.steps:
+            encoder(out, *values[i:i+n])
+            i += n
+        return bytes(out)
+
+    def decode(self, view):
+        '''Values of payload view, ValueError if it is malformed.'''
+        try:
+            if self.fixed is not None:
+                return self.fixed.unpack(view)      # struct.error unless exactly the right size
+            values = []
+            i = 0
+            for encoder, decoder, n in self.steps:
+                i = decoder(view, i, values)
+        except (struct.error, IndexError) as e:     # a length or field past the end of the payload
+            raise ValueError("truncated payload: %s" % e)
+        if i != len(view):      # slices past the end are silently short
+            raise ValueError("payload is %d bytes, the schema needs %d" % (len(view), i))
+        return values
+
+
+_MESSAGE_PLANS  = dict((name, _Plan(fields)) for name, fields in SCHEMAS.items())
+_RESPONSE_PLANS = dict((name, _Plan((fields,) if isinstance(fields, str) else fields)) for name, fields in RESPONSE_SCHEMAS.items())
+
+
+def encodeMessage(msg):
+    '''Payload of message tuple msg, None if it has no schema or doesn't fit it.'''
+    plan = _MESSAGE_PLANS.get(msg[0])
+    if plan is None:
+        return None
+    values = list(msg[1:])
+    try:
+        if msg[0] == "LIGHTING_BATCH" and values and not isinstance(values[0], (bytes, bytearray, memoryview)):
+            values[0] = packLighting(values[0])     # string posts or long orientations don't fit, pickle them
+        return plan.encode(values)
+    except (ValueError, TypeError, IndexError, AttributeError, struct.error):
+        return None
+
+def decodeMessage(name, payload):
+    '''Message tuple of type name from payload, any bytes-like object. ValueError for a malformed payload.'''
+    return (name,) + tuple(_MESSAGE_PLANS[name].decode(memoryview(payload)))
+
+def encodeResponse(request_name, obj):
+    '''Payload of the response obj to a request_name message, None if there is no schema or obj doesn't fit it.'''
+    plan = _RESPONSE_PLANS.get(request_name)
+    if plan is None:
+        return None
+    whole = isinstance(RESPONSE_SCHEMAS[request_name], str)
+    try:
+        return plan.encode([obj] if whole else list(obj))
+    except (ValueError, TypeError, IndexError, AttributeError, struct.error):
+        return None
+
+def decodeResponse(request_name, payload):
+    '''Response to a request_name message from payload. ValueError for a malformed payload.'''
+    values = _RESPONSE_PLANS[request_name].decode(memoryview(payload))
+    if isinstance(RESPONSE_SCHEMAS[request_name], str):
+        return values[0]
+    return tuple(values)
@@ -0,0 +1,732 @@
+#
+
+"""
+
+Networking building blocks for the Rooftop Lighting modules.
+
+Nothing in this module touches hardware, so the server and protocol code can
+be run and tested over loopback on a plain Linux box.
+
+"""
+
+import collections
+import concurrent.futures
+import logging
+import os
+import pickle
+import select
+import selectors
+import socket
+import struct
+import threading
+import time
+
+import rl_msg_codec
+from rl_lighting import LatencyHistogram
+
+
+class TCPServer:
+    # Accepts connections on a listening socket and handles them on a
+    # bounded pool of worker threads, so one slow or stalled client only ties
+    # up its own worker.
+    #
+    # A worker only holds a connection while it has data to read. A new
+    # connection that sends nothing within ACCEPT_LINGER, and a persistent
+    # connection between messages, is parked instead: serveForever() waits
+    # for it in a selector, together with the listening socket, and it holds
+    # no worker. So idle persistent connections (FramedClient) don't use up
+    # the workers other clients need. A parked new connection is closed if
+    # it sends nothing for read_timeout seconds, a parked persistent one after
+    # idle_timeout seconds (None = never). At most max_connections are open,
+    # further connections wait in the listen backlog. While a worker handles
+    # a connection every socket operation gets read_timeout seconds, a client
+    # stalling mid-message times out instead of holding the worker.
+    #
+    # handler(client, addr) is called on a worker thread once the new client
+    # is readable. It returns None when done with the client, which the server
+    # then closes, or a function resume() to park the client: resume() is
+    # called on a worker when the client is readable again, and returns the
+    # same way.
+    LISTEN_BACKLOG  = 64
+    ACCEPT_LINGER   = 0.002     # sec a worker waits for a new connection's first data before parking it
+
+    def __init__(self, port, handler, max_workers=8, read_timeout=5.0, log=None, host='', idle_timeout=None, max_connections=64):
+        self.handler = handler
+        self.max_workers = max_workers
+        self.read_timeout = read_timeout
+        self.idle_timeout = idle_timeout
+        self.max_connections = max_connections
+        self.log = log or logging.getLogger(__name__)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen(self.LISTEN_BACKLOG)
+        self.sock.setblocking(False)
+        self.port = self.sock.getsockname()[1]      # the port picked, if port was 0
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="client")
+        self.selector = selectors.DefaultSelector()
+        self.parked = {}        # client -> (addr, accept time, resume(), deadline, idle), serveForever() thread only
+        self.unparked = collections.deque()     # _park() arguments from the workers
+        self.wake_r, self.wake_w = socket.socketpair()      # wakes serveForever() from select()
+        self.wake_w.setblocking(False)
+        self.lock = threading.Lock()
+        self.active = 0         # connections a worker is handling
+        self.open = 0           # connections accepted and not closed, parked or active
+        self.n_connections = 0
+        self.n_timeouts = 0
+        self.n_idle_closed = 0
+        self.n_errors = 0
+        self.latency = LatencyHistogram()   # accept to connection closed
+        self.running = True
+
+    def serveForever(self):
+        self.selector.register(self.wake_r, selectors.EVENT_READ)
+        self.selector.register(self.sock, selectors.EVENT_READ)
+        accepting = True
+        while self.running:
+            deadlines = [entry[3] for entry in self.parked.values() if entry[3] is not None]
+            timeout = max(min(deadlines) - time.monotonic(), 0.0) if deadlines else None
+            for key, events in self.selector.select(timeout):
+                if not self.running:
+                    break
+                if key.fileobj is self.sock:
+                    self._accept()
+                elif key.fileobj is self.wake_r:
+                    self.wake_r.recv(4096)
+                else:
+                    self._unpark(key.fileobj)
+            while self.unparked:
+                self._park(*self.unparked.popleft())
+            self._closeExpired()
+            if not self.running:
+                break
+            # at max_connections stop accepting, the listen backlog holds the rest
+            with self.lock:
+                full = self.open >= self.max_connections
+            if full and accepting:
+                self.selector.unregister(self.sock)
+                accepting = False
+            elif not full and not accepting:
+                self.selector.register(self.sock, selectors.EVENT_READ)
+                accepting = True
+        for client in list(self.parked) + [entry[0] for entry in self.unparked]:
+            client.close()
+        self.selector.close()
+        self.wake_r.close()
+
+    def _accept(self):
+        try:
+            client, addr = self.sock.accept()
+        except BlockingIOError:
+            return
+        except OSError:
+            if not self.running:    # close() closed the listening socket
+                return
+            raise
+        client.settimeout(self.read_timeout)
+        with self.lock:
+            self.open += 1
+            self.active += 1
+            self.n_connections += 1
+        self.pool.submit(self._handle, client, addr, time.monotonic(), lambda: self.handler(client, addr), True)
+
+    def _park(self, client, addr, t_accept, resume, wait, idle):
+        deadline = time.monotonic() + wait if wait is not None else None
+        self.parked[client] = (addr, t_accept, resume, deadline, idle)
+        self.selector.register(client, selectors.EVENT_READ)
+
+    def _unpark(self, client):
+        '''client is readable, hand it to a worker.'''
+        self.selector.unregister(client)
+        addr, t_accept, resume, deadline, idle = self.parked.pop(client)
+        with self.lock:
+            self.active += 1
+        self.pool.submit(self._handle, client, addr, t_accept, resume)
+
+    def _closeExpired(self):
+        now = time.monotonic()
+        for client, (addr, t_accept, resume, deadline, idle) in list(self.parked.items()):
+            if deadline is None or now < deadline:
+                continue
+            self.selector.unregister(client)
+            del self.parked[client]
+            if idle:
+                with self.lock:
+                    self.n_idle_closed += 1
+                self.log.debug("Closing idle client %s", addr[0])
+            else:
+                with self.lock:
+                    self.n_timeouts += 1
+                self.log.warning("Client %s sent nothing, timed out", addr[0])
+            self._close(client, t_accept)
+
+    def _close(self, client, t_accept):
+        '''Close client, returns True if that makes room for a connection waiting in the backlog.'''
+        client.close()
+        with self.lock:
+            self.open -= 1
+            self.latency.record(time.monotonic() - t_accept)
+            return self.open == self.max_connections - 1
+
+    def _wake(self):
+        try:
+            self.wake_w.send(b"\0")
+        except OSError:     # buffer full, serveForever() is waking anyway
+            pass
+
+    def _handle(self, client, addr, t_accept, resume, new=False):
+        if new and not select.select([client], [], [], self.ACCEPT_LINGER)[0]:
+            # nothing sent yet, wait in the selector rather than on a worker
+            with self.lock:
+                self.active -= 1
+            self.unparked.append((client, addr, t_accept, resume, self.read_timeout, False))
+            self._wake()
+            return
+        try:
+            resume = resume()
+        except socket.timeout:
+            resume = None
+            with self.lock:
+                self.n_timeouts += 1
+            self.log.warning("Client %s timed out", addr[0])
+        except Exception:
+            resume = None
+            with self.lock:
+                self.n_errors += 1
+            self.log.exception("Error handling client %s", addr[0])
+        with self.lock:
+            self.active -= 1
+        if resume is not None and self.running:
+            self.unparked.append((client, addr, t_accept, resume, self.idle_timeout, True))
+            self._wake()
+        elif self._close(client, t_accept):
+            self._wake()
+
+    def close(self):
+        self.running = False
+        self._wake()
+        self.wake_w.close()
+        self.sock.close()
+        self.pool.shutdown(wait=False)
+
+    def report(self):
+        with self.lock:
+            return dict(active=self.active, open=self.open, parked=len(self.parked), max_workers=self.max_workers,
+                        connections=self.n_connections, timeouts=self.n_timeouts, idle_closed=self.n_idle_closed,
+                        errors=self.n_errors, latency=self.latency.report())
+
+
+# Framed protocol
+#
+# A connection carries any number of frames, in both directions:
+#   header  2s magic "RL", u8 version, u8 payload encoding, u16 message type,
+#           u32 request id, u32 payload length, network byte order
+#   payload length bytes
+# Requests that expect an answer get a RESPONSE frame with the same request id,
+# in the encoding of the request.
+# A connection that doesn't start with the magic is a legacy client: one
+# pickled message, then the client shuts down its side.
+#
+# Encoding negotiation: a client that can send ENCODING_BINARY (rl_msg_codec)
+# opens with a HELLO frame, payload the encodings it accepts in order of
+# preference, and the server answers with a one byte payload, the encoding to
+# use. A client that doesn't send HELLO uses pickle, as does any message that
+# doesn't fit its binary schema. A server without binary support closes the
+# connection on HELLO, the client then reconnects and stays with pickle.
+FRAME_MAGIC     = b"RL"
+FRAME_VERSION   = 2             # 2: ENCODING_BINARY and HELLO
+FRAME_HEADER    = struct.Struct("!2sBBHII")
+
+ENCODING_PICKLE = 0
+ENCODING_BINARY = 1             # rl_msg_codec schemas
+
+# message type field of the frame header
+MSG_TYPE_IDS = {
+    "RESPONSE"       : 0,
+    "DISPLAY"        : 1,
+    "LIGHTING"       : 2,
+    "LIGHTING_BATCH" : 3,
+    "VIDEO"          : 4,
+    "VI_QUERY"       : 5,
+    "VI_HISTORY"     : 6,
+    "FLOW_QUERY"     : 7,
+    "FLOW_HISTORY"   : 8,
+    "TEMP_QUERY"     : 9,
+    "PLAY_AUDIO"     : 10,
+    "SOUND"          : 11,
+    "HEALTH_NOTICE"  : 12,
+    "HELLO"          : 13,      # encoding negotiation, not passed to the message handler
+}
+MSG_TYPE_NAMES  = dict((n, name) for name, n in MSG_TYPE_IDS.items())
+MSG_TYPE_OTHER  = 0xffff        # type not in MSG_TYPE_IDS, the payload says which
+
+
+class FramedConnection:
+    # One end of a persistent connection carrying length prefixed frames.
+    # Receives go into one preallocated buffer with recv_into, reading as
+    # much as the socket has, so several small frames cost one system call
+    # and no frame is assembled by concatenating bytes.
+    RECV_BUFFER = 64 * 1024     # bytes, grows to fit a larger frame
+    MAX_FRAME   = 4 * 1024 * 1024   # bytes of payload, a larger length is a ValueError rather than an allocation
+
+    def __init__(self, sock, received=b""):
+        '''received is data already read from sock, the start of the first frame.'''
+        self.sock = sock
+        self.buf = bytearray(max(self.RECV_BUFFER, len(received)))
+        self.view = memoryview(self.buf)
+        self.buf[:len(received)] = received
+        self.start = 0      # first unread byte in buf
+        self.end = len(received)    # end of received data in buf
+
+    def _fill(self, n):
+        '''Receive until n unread bytes are buffered. Returns False on end of stream before any of them.'''
+        while self.end - self.start < n:
+            if self.start + n > len(self.buf):
+                # move the unread bytes to the front, growing the buffer if the frame doesn't fit
+                unread = self.end - self.start
+                if n > len(self.buf):
+                    buf = bytearray(max(n, 2 * len(self.buf)))
+                    buf[:unread] = self.view[self.start:self.end]
+                    self.view.release()
+                    self.buf = buf
+                    self.view = memoryview(buf)
+                else:
+                    self.buf[:unread] = self.buf[self.start:self.end]
+                self.start, self.end = 0, unread
+            received = self.sock.recv_into(self.view[self.end:])
+            if received == 0:
+                if self.end == self.start:
+                    return False
+                raise ConnectionError("connection closed in the middle of a frame")
+            self.end += received
+        return True
+
+    def buffered(self):
+        '''Bytes received and not yet returned in a frame.'''
+        return self.end - self.start
+
+    def readable(self, timeout):
+        '''True if data is buffered or arrives (or the peer closes) within timeout seconds.'''
+        return self.end > self.start or bool(select.select([self.sock], [], [], timeout)[0])
+
+    def recvFrame(self):
+        '''Next frame as (message type, request id, encoding, payload), None when the peer has closed.
+
+        payload is a memoryview into the receive buffer, valid until the next recvFrame().
+        ValueError for a frame without the magic or longer than MAX_FRAME.
+        '''
+        if not self._fill(FRAME_HEADER.size):
+            return None
+        magic, version, encoding, msg_type, request_id, length = FRAME_HEADER.unpack_from(self.buf, self.start)
+        if magic != FRAME_MAGIC:
+            raise ValueError("bad frame magic %r" % magic)
+        if length > self.MAX_FRAME:
+            raise ValueError("frame of %d bytes, the limit is %d" % (length, self.MAX_FRAME))
+        self.start += FRAME_HEADER.size
+        if not self._fill(length):
+            raise ConnectionError("connection closed in the middle of a frame")
+        payload = self.view[self.start:self.start+length]
+        self.start += length
+        return msg_type, request_id, encoding, payload
+
+    def sendFrame(self, msg_type, request_id, payload, encoding=ENCODING_PICKLE):
+        self.sock.sendall(FRAME_HEADER.pack(FRAME_MAGIC, FRAME_VERSION, encoding, msg_type, request_id, len(payload)) + payload)
+
+    def sendMessage(self, msg, request_id=0, encoding=ENCODING_PICKLE):
+        '''Send a message, a tuple starting with its type name. Binary falls back to pickle for a message without a schema.'''
+        msg_type = MSG_TYPE_IDS.get(msg[0], MSG_TYPE_OTHER)
+        payload = None
+        if encoding == ENCODING_BINARY and msg_type != MSG_TYPE_OTHER:
+            payload = rl_msg_codec.encodeMessage(msg)
+        if payload is None:
+            payload, encoding = pickle.dumps(msg, pickle.HIGHEST_PROTOCOL), ENCODING_PICKLE
+        self.sendFrame(msg_type, request_id, payload, encoding)
+
+    def sendResponse(self, obj, request_id, request_name, encoding=ENCODING_PICKLE):
+        '''Send the response obj to the request_name message request_id, in the request's encoding where obj fits the schema.'''
+        payload = None
+        if encoding == ENCODING_BINARY:
+            payload = rl_msg_codec.encodeResponse(request_name, obj)
+        if payload is None:
+            payload, encoding = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL), ENCODING_PICKLE
+        self.sendFrame(MSG_TYPE_IDS["RESPONSE"], request_id, payload, encoding)
+
+    def recvMessage(self):
+        '''Next message as (message type, request id, encoding, message), None when the peer has closed.
+
+        Binary messages are decoded without copying the payload, BLOB fields
+        are memoryviews into the receive buffer, valid until the next receive.
+        Binary RESPONSE and HELLO payloads are returned undecoded.
+        '''
+        frame = self.recvFrame()
+        if frame is None:
+            return None
+        return self._decode(frame)
+
+    def _decode(self, frame):
+        msg_type, request_id, encoding, payload = frame
+        if encoding == ENCODING_PICKLE:
+            return msg_type, request_id, encoding, pickle.loads(payload)
+        if encoding != ENCODING_BINARY:
+            raise ValueError("unknown payload encoding %d" % encoding)
+        name = MSG_TYPE_NAMES.get(msg_type)
+        if name in ("RESPONSE", "HELLO"):
+            return msg_type, request_id, encoding, payload
+        if name not in rl_msg_codec.SCHEMAS:
+            raise ValueError("no binary schema for message type %d" % msg_type)
+        return msg_type, request_id, encoding, rl_msg_codec.decodeMessage(name, payload)
+
+
+class FramedClient:
+    # Persistent framed connection to a server, connected on first use and
+    # reconnected on the next message after an error. Thread safe.
+    #
+    # send() is for messages without an answer (DISPLAY, HEALTH_NOTICE),
+    # request() waits for the RESPONSE frame with the message's request id.
+    # With binary set, the encoding is negotiated with HELLO on connecting.
+    def __init__(self, host, port, timeout=5.0, binary=True):
+        self.address = (host, port)
+        self.timeout = timeout
+        self.binary = binary
+        self.encoding = ENCODING_PICKLE     # negotiated on connecting
+        self.conn = None
+        self.lock = threading.Lock()
+        self.next_id = 1
+        self.pending = {}       # request id -> request message type name
+        self.responses = {}     # request id -> response received while waiting for another
+
+    def _connect(self):
+        sock = socket.create_connection(self.address, self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return FramedConnection(sock)
+
+    def _connection(self):
+        if self.conn is None:
+            self.conn = self._connect()
+            self.encoding = ENCODING_PICKLE
+            if self.binary:
+                self.conn.sendFrame(MSG_TYPE_IDS["HELLO"], 0, bytes([ENCODING_BINARY, ENCODING_PICKLE]))
+                try:
+                    reply = self.conn.recvFrame()
+                except ConnectionError:
+                    reply = None
+                if reply is None:
+                    # server without binary support, stay with pickle from now on
+                    self.conn.sock.close()
+                    self.binary = False
+                    self.conn = self._connect()
+                elif len(reply[3]) == 1:
+                    self.encoding = reply[3][0]
+        return self.conn
+
+    def close(self):
+        with self.lock:
+            self._close()
+
+    def _close(self):
+        if self.conn is not None:
+            self.conn.sock.close()
+            self.conn = None
+            self.pending.clear()
+            self.responses.clear()
+
+    def send(self, msg):
+        with self.lock:
+            try:
+                conn = self._connection()
+                conn.sendMessage(msg, 0, self.encoding)
+            except OSError:
+                self._close()
+                raise
+
+    def request(self, msg):
+        '''Send msg and return the response.'''
+        with self.lock:
+            request_id = self.next_id
+            self.next_id = (self.next_id % 0xffffffff) + 1
+            try:
+                conn = self._connection()
+                self.pending[request_id] = msg[0]
+                conn.sendMessage(msg, request_id, self.encoding)
+                while request_id not in self.responses:
+                    frame = conn.recvFrame()
+                    if frame is None:
+                        raise ConnectionError("server closed the connection")
+                    msg_type, reply_id, encoding, payload = frame
+                    name = self.pending.pop(reply_id, None)
+                    if encoding == ENCODING_BINARY and name is not None:
+                        self.responses[reply_id] = rl_msg_codec.decodeResponse(name, payload)
+                    elif encoding == ENCODING_PICKLE:
+                        self.responses[reply_id] = pickle.loads(payload)
+                    else:
+                        raise ValueError("unexpected response encoding %d" % encoding)
+            except (OSError, ValueError):
+                self._close()
+                raise
+            return self.responses.pop(request_id)
+
+
+SERVE_LINGER    = 0.002         # sec a worker waits for the next frame before a framed connection is parked
+
+
+def serveConnection(client, handle, allow_pickle=True):
+    '''Serve one accepted connection, legacy pickle or framed, calling handle(msg, reply) for every message.
+
+    reply(obj) sends obj back to the client: pickled on a legacy connection,
+    as the RESPONSE frame to the message's request id on a framed one.
+    msg is only valid during handle(), copy BLOB fields to keep them.
+    Returns None once the connection is done. A framed connection returns
+    once no frame has arrived for SERVE_LINGER seconds, with a function
+    continuing it when the client is readable again, a TCPServer resume().
+    Without allow_pickle, legacy connections and pickled frames are refused
+    (ValueError), only binary messages are accepted.
+    '''
+    # read the whole magic, a first segment of 1 byte isn't taken for a legacy client
+    head = b""
+    while len(head) < len(FRAME_MAGIC):
+        data = client.recv(len(FRAME_MAGIC) - len(head))
+        if not data:
+            break
+        head += data
+    if head != FRAME_MAGIC:
+        if not allow_pickle:
+            raise ValueError("legacy pickle connection refused")
+        chunks = [head] if head else []
+        while True:
+            data = client.recv(4096)
+            if not data:
+                # client has sent message and shut down connection
+                break
+            chunks.append(data)
+        if not chunks:
+            return
+        handle(pickle.loads(b"".join(chunks)), lambda obj: client.sendall(pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)))
+        return
+
+    client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return _serveFrames(FramedConnection(client, head), handle, allow_pickle)
+
+def _serveFrames(conn, handle, allow_pickle):
+    while True:
+        frame = conn.recvFrame()
+        if frame is None:
+            return None
+        msg_type, request_id, encoding, payload = frame
+        if msg_type == MSG_TYPE_IDS["HELLO"]:
+            accepted = [e for e in payload if e == ENCODING_BINARY or (e == ENCODING_PICKLE and allow_pickle)]
+            conn.sendFrame(MSG_TYPE_IDS["RESPONSE"], request_id, bytes(accepted[:1] or [ENCODING_BINARY]))
+        elif encoding == ENCODING_PICKLE and not allow_pickle:
+            raise ValueError("pickled message refused")
+        else:
+            msg_type, request_id, encoding, msg = conn._decode(frame)
+            handle(msg, lambda obj: conn.sendResponse(obj, request_id, msg[0], encoding))
+        if not conn.readable(SERVE_LINGER):    # wait for the next frame without holding a worker
+            return lambda: _serveFrames(conn, handle, allow_pickle)
+
+
+class Dispatcher:
+    # Message type name -> handler(msg, reply) table.
+    #
+    # Subsystems register their handlers as they start, then freeze() keeps
+    # the handlers this node type serves (per MSG_TYPES) in the table used by
+    # dispatch(), so the node type is checked once at startup and a message
+    # costs one dict lookup. Handlers can't be registered after freeze().
+    #
+    # Every handler has a call count, an error count and a latency histogram.
+    def __init__(self, log=None):
+        self.log = log or logging.getLogger(__name__)
+        self.registered = {}    # message type -> handler
+        self.table = None       # message type -> (handler, stats), set by freeze()
+        self.msg_types = {}
+        self.lock = threading.Lock()
+
+    def register(self, msg_type, handler):
+        if self.table is not None:
+            raise RuntimeError("handler for %s registered after dispatch table was frozen" % msg_type)
+        if msg_type in self.registered:
+            raise ValueError("handler for %s already registered" % msg_type)
+        self.registered[msg_type] = handler
+
+    def freeze(self, node_type, msg_types):
+        '''Build the dispatch table of the registered handlers node_type serves, msg_types is MSG_TYPES.'''
+        self.msg_types = msg_types
+        table = {}
+        for msg_type, handler in self.registered.items():
+            if msg_type not in msg_types or node_type not in msg_types[msg_type]:
+                self.log.info("Handler for %s not used, message type not handled by node type %s", msg_type, node_type)
+                continue
+            table[msg_type] = (handler, dict(calls=0, errors=0, latency=LatencyHistogram()))
+        self.table = table
+
+    def dispatch(self, msg, reply):
+        '''Call the handler for msg, returns False if there is none.'''
+        entry = self.table.get(msg[0])
+        if entry is None:
+            if msg[0] not in self.msg_types:
+                self.log.warning("Unknown message type received: %s", msg[0])
+            else:
+                self.log.warning("Message type %s cannot be handled by this node type", msg[0])
+            return False
+        handler, stats = entry
+        t_start = time.perf_counter()
+        try:
+            handler(msg, reply)
+        except Exception:
+            with self.lock:
+                stats["errors"] += 1
+            raise
+        finally:
+            t = time.perf_counter() - t_start
+            with self.lock:
+                stats["calls"] += 1
+                stats["latency"].record(t)
+        return True
+
+    def report(self):
+        with self.lock:
+            return dict((msg_type, dict(calls=stats["calls"], errors=stats["errors"], latency=stats["latency"].report()))
+                        for msg_type, (handler, stats) in self.table.items())
+
+
+# Multicast
+#
+# Idempotent lighting commands can be sent to a multicast group, one datagram
+# reaching every listening node at once. A datagram is
+#   header  2s magic "RM", u8 version, u8 payload encoding (ENCODING_BINARY),
+#           u32 sender id, u32 sequence number, u16 message type, network byte order
+#   payload the rl_msg_codec encoding of the message
+# Sequence numbers count up per sender (a random id per MulticastSender), a
+# listener only acts on a sequence number newer than the last it accepted from
+# that sender, so repeats for loss tolerance and datagrams delivered out of
+# order are dropped instead of bringing an older scene back.
+MULTICAST_MAGIC     = b"RM"
+MULTICAST_VERSION   = 1
+MULTICAST_HEADER    = struct.Struct("!2sBBIIH")
+MULTICAST_MAX       = 1400          # bytes per datagram, no IP fragmentation on an Ethernet or WiFi MTU
+MULTICAST_TYPES     = ("DISPLAY", "LIGHTING", "LIGHTING_BATCH", "VIDEO")    # idempotent, safe to repeat
+
+
+class MulticastSender:
+    # Sends MULTICAST_TYPES messages to a multicast group. repeat extra
+    # copies of every datagram are sent repeat_interval seconds apart, send()
+    # returns after the last one. Thread safe.
+    def __init__(self, group, port, repeat=0, repeat_interval=0.002, ttl=1, interface=None):
+        self.address = (group, port)
+        self.repeat = repeat
+        self.repeat_interval = repeat_interval
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)     # listeners on this host get it too
+        if interface is not None:
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(interface))
+        self.sender_id = int.from_bytes(os.urandom(4), "big")
+        self.sequence = 0
+        self.lock = threading.Lock()
+
+    def send(self, msg):
+        '''Send msg to the group, returns its sequence number. ValueError if msg can't go by multicast.'''
+        if msg[0] not in MULTICAST_TYPES:
+            raise ValueError("%s is not sent by multicast" % msg[0])
+        payload = rl_msg_codec.encodeMessage(msg)
+        if payload is None or MULTICAST_HEADER.size + len(payload) > MULTICAST_MAX:
+            raise ValueError("%s message doesn't fit a multicast datagram" % msg[0])
+        with self.lock:
+            self.sequence = (self.sequence + 1) & 0xffffffff
+            sequence = self.sequence
+            datagram = MULTICAST_HEADER.pack(MULTICAST_MAGIC, MULTICAST_VERSION, ENCODING_BINARY,
+                                             self.sender_id, sequence, MSG_TYPE_IDS[msg[0]]) + payload
+            self.sock.sendto(datagram, self.address)
+            for k in range(self.repeat):
+                time.sleep(self.repeat_interval)
+                self.sock.sendto(datagram, self.address)
+        return sequence
+
+    def close(self):
+        self.sock.close()
+
+
+class MulticastListener:
+    # Joins a multicast group and calls handle(msg) for every new message.
+    # Several listeners on one host can share the port, e.g. for testing over
+    # loopback with interface "127.0.0.1".
+    #
+    # msg is only valid during handle(), copy BLOB fields to keep them.
+    RECV_BUFFER = 2048
+    MAX_SENDERS = 16        # senders whose last sequence number is remembered
+
+    def __init__(self, group, port, handle, interface="0.0.0.0", log=None):
+        self.handle = handle
+        self.log = log or logging.getLogger(__name__)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, "SO_REUSEPORT"):
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.sock.bind(("", port))
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, socket.inet_aton(group) + socket.inet_aton(interface))
+        self.last = {}          # sender id -> last sequence number accepted
+        self.n_received = 0
+        self.n_accepted = 0
+        self.n_duplicates = 0   # repeats and datagrams older than one already accepted
+        self.n_lost = 0         # sequence numbers never received
+        self.n_malformed = 0
+        self.running = True
+
+    def serveForever(self):
+        buf = bytearray(self.RECV_BUFFER)
+        view = memoryview(buf)
+        while self.running:
+            try:
+                n = self.sock.recv_into(buf)
+            except OSError:
+                if not self.running:    # close() shut the socket
+                    return
+                raise
+            self.receive(view[:n])
+
+    def receive(self, data):
+        '''Handle one datagram, returns True if it was a new message.'''
+        self.n_received += 1
+        if len(data) < MULTICAST_HEADER.size:
+            self.n_malformed += 1
+            return False
+        magic, version, encoding, sender_id, sequence, msg_type = MULTICAST_HEADER.unpack_from(data)
+        name = MSG_TYPE_NAMES.get(msg_type)
+        if magic != MULTICAST_MAGIC or encoding != ENCODING_BINARY or name not in MULTICAST_TYPES:
+            self.n_malformed += 1
+            return False
+
+        last = self.last.get(sender_id)
+        if last is not None:
+            ahead = (sequence - last) & 0xffffffff
+            if ahead == 0 or ahead >= 0x80000000:      # serial number arithmetic, the sequence wraps
+                self.n_duplicates += 1
+                return False
+        try:
+            msg = rl_msg_codec.decodeMessage(name, data[MULTICAST_HEADER.size:])
+        except ValueError:
+            self.n_malformed += 1
+            return False
+
+        if last is not None:
+            self.n_lost += ahead - 1
+        elif len(self.last) >= self.MAX_SENDERS:
+            del self.last[next(iter(self.last))]    # forget the longest known sender
+        self.last[sender_id] = sequence
+        self.n_accepted += 1
+        try:
+            self.handle(msg)
+        except Exception:
+            self.log.exception("Error handling multicast %s", name)
+        return True
+
+    def close(self):
+        self.running = False
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)    # wakes a blocked recv_into()
+        except OSError:
+            pass
+        self.sock.close()
+
+    def report(self):
+        return dict(received=self.n_received, accepted=self.n_accepted, duplicates=self.n_duplicates,
+                    lost=self.n_lost, malformed=self.n_malformed)
@@ -0,0 +1,69 @@
+#
+
+"""
+
+Round trip tests of the rl_frame_codec CM to DM frame encoding.
+
+    python -m unittest test_rl_frame_codec
+
+"""
+
+import random
+import unittest
+
+import rl_frame_codec
+
+
+def runs(*runs):
+    '''Frame of (pixel count, (r, g, b)) runs.'''
+    return b"".join(bytes(color) * count for count, color in runs)
+
+
+class FrameCodecTest(unittest.TestCase):
+    def roundTrip(self, frame, fmt=None):
+        data = rl_frame_codec.encodeFrame(frame)
+        if fmt is not None:
+            self.assertEqual(data[0], fmt)
+        self.assertEqual(bytes(rl_frame_codec.decodeFrame(data)), bytes(frame))
+        return data
+
+    def test_uniform_frame(self):
+        data = self.roundTrip(bytes((10, 20, 30)) * 2000000, rl_frame_codec.FORMAT_PALETTE)
+        self.assertLessEqual(len(data), 14)
+
+    def test_few_colors_use_palette(self):
+        self.roundTrip(runs((100, (255, 0, 0)), (1, (0, 0, 0)), (300, (0, 255, 0)), (100, (255, 0, 0))), rl_frame_codec.FORMAT_PALETTE)
+
+    def test_many_colors_in_runs_use_rle(self):
+        self.roundTrip(runs(*[(4, (k % 256, k // 256, 7)) for k in range(600)]), rl_frame_codec.FORMAT_RLE)
+
+    def test_noise_is_raw(self):
+        rng = random.Random(1)
+        self.roundTrip(bytes(rng.randrange(256) for k in range(3 * 1000)), rl_frame_codec.FORMAT_RAW)
+
+    def test_small_frames(self):
+        self.roundTrip(b"")
+        self.roundTrip(b"\x01\x02\x03")
+        self.roundTrip(runs((1, (1, 2, 3)), (1, (4, 5, 6))))
+
+    def test_long_runs_multibyte_varints(self):
+        for count in (127, 128, 16383, 16384, 300000):
+            self.roundTrip(runs((count, (1, 2, 3)), (1, (9, 9, 9))))
+
+    def test_decode_into_buffer(self):
+        frame = runs((50, (1, 2, 3)), (50, (4, 5, 6)))
+        buf = bytearray(len(frame))
+        self.assertIs(rl_frame_codec.decodeFrame(rl_frame_codec.encodeFrame(memoryview(frame)), buf), buf)
+        self.assertEqual(bytes(buf), frame)
+
+    def test_frame_runs(self):
+        frame = runs((3, (1, 1, 1)), (2, (2, 2, 2)))
+        self.assertEqual(rl_frame_codec.frameRuns(frame), [(3, b"\x01\x01\x01"), (2, b"\x02\x02\x02")])
+        self.assertIsNone(rl_frame_codec.frameRuns(frame, max_runs=1))
+
+    def test_unknown_format(self):
+        self.assertRaises(ValueError, rl_frame_codec.decodeFrame, b"\x07\x01")
+
+
+if __name__ == "__main__":
+    unittest.main()
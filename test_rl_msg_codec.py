@@ -0,0 +1,141 @@
+#
+
+"""
+
+Tests of the rl_msg_codec binary message encoding and of the encoding
+negotiation between rl_net framed clients and servers.
+
+    python -m unittest test_rl_msg_codec
+
+"""
+
+import pickle
+import threading
+import unittest
+
+import rl_msg_codec
+import rl_net
+from rl_lighting import unpackLighting
+from test_rl_net import LOOPBACK, startServer
+
+
+# a value of every field kind, and the value it decodes to
+SAMPLES = {
+    "U16"     : (12, 12),
+    "F32"     : (0.5, 0.5),
+    "F64"     : (48.125, 48.125),
+    "COLOR"   : ((255, 128, 0), (255, 128, 0)),
+    "STR"     : ("north é", "north é"),
+    "BLOB"    : (b"\x00\x01\xff", b"\x00\x01\xff"),
+    "JSON"    : ({"node" : "rooftop", "frames" : [1, 2]}, {"node" : "rooftop", "frames" : [1, 2]}),
+    "STRLIST" : (["2024-06-01 front 3.5", ""], ["2024-06-01 front 3.5", ""]),
+    "PAIRS"   : ([(48.0, 250.0), (47.5, 0.25)], [(48.0, 250.0), (47.5, 0.25)]),
+}
+
+
+def plain(value):
+    '''value with memoryviews (decoded BLOBs) as bytes, for comparing.'''
+    return bytes(value) if isinstance(value, memoryview) else value
+
+
+class MessageCodecTest(unittest.TestCase):
+    def test_every_message_schema_round_trips(self):
+        for name, fields in rl_msg_codec.SCHEMAS.items():
+            with self.subTest(name):
+                msg = (name,) + tuple(SAMPLES[kind][0] for kind in fields)
+                payload = rl_msg_codec.encodeMessage(msg)
+                self.assertIsNotNone(payload)
+                decoded = rl_msg_codec.decodeMessage(name, payload)
+                self.assertEqual(tuple(plain(v) for v in decoded), (name,) + tuple(SAMPLES[kind][1] for kind in fields))
+
+    def test_every_response_schema_round_trips(self):
+        for name, fields in rl_msg_codec.RESPONSE_SCHEMAS.items():
+            with self.subTest(name):
+                if isinstance(fields, str):
+                    obj, expected = SAMPLES[fields]
+                else:
+                    obj, expected = tuple(SAMPLES[kind][0] for kind in fields), tuple(SAMPLES[kind][1] for kind in fields)
+                payload = rl_msg_codec.encodeResponse(name, obj)
+                self.assertIsNotNone(payload)
+                self.assertEqual(rl_msg_codec.decodeResponse(name, payload), expected)
+
+    def test_lighting_batch_entries_packed(self):
+        entries = [(3, "N", (255, 0, 10), 1.0), (70, "SW", (1, 2, 3), 0.0)]
+        payload = rl_msg_codec.encodeMessage(("LIGHTING_BATCH", entries))
+        blob = rl_msg_codec.decodeMessage("LIGHTING_BATCH", payload)[1]
+        self.assertEqual(list(unpackLighting(blob)), entries)
+
+    def test_misfits_return_none(self):
+        self.assertIsNone(rl_msg_codec.encodeMessage(("NOT_A_TYPE", 1)))
+        self.assertIsNone(rl_msg_codec.encodeMessage(("DISPLAY", "RED", "HIGH")))               # too few fields
+        self.assertIsNone(rl_msg_codec.encodeMessage(("DISPLAY", "RED" * 100, "HIGH", "STEADY")))    # STR over 255 bytes
+        self.assertIsNone(rl_msg_codec.encodeMessage(("LIGHTING", 70000, "N", (1, 2, 3), 1.0)))  # post over u16
+        self.assertIsNone(rl_msg_codec.encodeMessage(("LIGHTING", "3", "N", (1, 2, 3), 1.0)))
+        self.assertIsNone(rl_msg_codec.encodeMessage(("LIGHTING_BATCH", [(3, "NORTH", (1, 2, 3), 1.0)])))
+        self.assertIsNone(rl_msg_codec.encodeResponse("VI_QUERY", (48.0,)))
+        self.assertIsNone(rl_msg_codec.encodeResponse("FLOW_HISTORY", None))
+        self.assertIsNone(rl_msg_codec.encodeResponse("PLAY_AUDIO", "ok"))
+
+    def test_malformed_payloads_raise_value_error(self):
+        self.assertRaises(ValueError, rl_msg_codec.decodeMessage, "LIGHTING", b"")
+        for name, fields in rl_msg_codec.SCHEMAS.items():
+            payload = rl_msg_codec.encodeMessage((name,) + tuple(SAMPLES[kind][0] for kind in fields))
+            with self.subTest(name):
+                for n in range(len(payload)):
+                    self.assertRaises(ValueError, rl_msg_codec.decodeMessage, name, payload[:n])
+                self.assertRaises(ValueError, rl_msg_codec.decodeMessage, name, payload + b"\0")
+        for name in rl_msg_codec.RESPONSE_SCHEMAS:
+            with self.subTest(name):
+                self.assertRaises(ValueError, rl_msg_codec.decodeResponse, name, b"\x01")
+
+
+class NegotiationTest(unittest.TestCase):
+    def handle(self, msg, reply):
+        if msg[0] == "VI_QUERY":
+            reply((48.0, 250.0))
+
+    def test_binary_negotiated(self):
+        server = startServer(self, self.handle)
+        client = rl_net.FramedClient(LOOPBACK, server.port)
+        self.addCleanup(client.close)
+        self.assertEqual(client.request(("VI_QUERY",)), (48.0, 250.0))
+        self.assertEqual(client.encoding, rl_net.ENCODING_BINARY)
+
+    def test_fallback_to_pickle_only_server(self):
+        # a framed server without binary support: pickle payloads only, errors on anything else
+        def pickleOnly(client, addr):
+            conn = rl_net.FramedConnection(client)
+            while True:
+                frame = conn.recvFrame()
+                if frame is None:
+                    return
+                msg_type, request_id, encoding, payload = frame
+                msg = pickle.loads(payload)     # raises on HELLO's raw payload, closing the connection
+                conn.sendFrame(rl_net.MSG_TYPE_IDS["RESPONSE"], request_id, pickle.dumps(("old", msg[0])))
+
+        server = rl_net.TCPServer(0, pickleOnly, host=LOOPBACK)
+        server.log.disabled = True
+        self.addCleanup(setattr, server.log, "disabled", False)
+        threading.Thread(target=server.serveForever, daemon=True).start()
+        self.addCleanup(server.close)
+        client = rl_net.FramedClient(LOOPBACK, server.port)
+        self.addCleanup(client.close)
+        self.assertEqual(client.request(("VI_QUERY",)), ("old", "VI_QUERY"))
+        self.assertEqual(client.encoding, rl_net.ENCODING_PICKLE)
+        self.assertFalse(client.binary)
+        self.assertEqual(client.request(("VI_QUERY",)), ("old", "VI_QUERY"))
+
+    def test_pickle_refused(self):
+        server = startServer(self, self.handle, allow_pickle=False)
+        server.log.disabled = True
+        self.addCleanup(setattr, server.log, "disabled", False)
+        binary = rl_net.FramedClient(LOOPBACK, server.port)
+        self.addCleanup(binary.close)
+        self.assertEqual(binary.request(("VI_QUERY",)), (48.0, 250.0))
+        pickled = rl_net.FramedClient(LOOPBACK, server.port, binary=False)
+        self.addCleanup(pickled.close)
+        self.assertRaises(ConnectionError, pickled.request, ("VI_QUERY",))
+
+
+if __name__ == "__main__":
+    unittest.main()
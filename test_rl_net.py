@@ -0,0 +1,228 @@
+#
+
+"""
+
+Loopback tests of the rl_net wire protocols.
+
+    python -m unittest test_rl_net
+
+"""
+
+import pickle
+import socket
+import threading
+import time
+import unittest
+
+import rl_msg_codec
+import rl_net
+
+
+MULTICAST_GROUP = "239.255.76.63"
+LOOPBACK = "127.0.0.1"
+
+
+def startServer(test, handle, read_timeout=5.0, idle_timeout=None, allow_pickle=True, max_workers=8):
+    '''TCPServer on an ephemeral loopback port serving handle(msg, reply), closed when test ends.'''
+    server = rl_net.TCPServer(0, lambda client, addr: rl_net.serveConnection(client, handle, allow_pickle), max_workers,
+                              read_timeout, host=LOOPBACK, idle_timeout=idle_timeout)
+    threading.Thread(target=server.serveForever, daemon=True).start()
+    test.addCleanup(server.close)
+    return server
+
+
+def datagram(sender_id, sequence, msg):
+    return rl_net.MULTICAST_HEADER.pack(rl_net.MULTICAST_MAGIC, rl_net.MULTICAST_VERSION, rl_net.ENCODING_BINARY,
+                                        sender_id, sequence, rl_net.MSG_TYPE_IDS[msg[0]]) + rl_msg_codec.encodeMessage(msg)
+
+
+class MulticastSequenceTest(unittest.TestCase):
+    # MulticastListener.receive() fed datagrams directly
+    def setUp(self):
+        self.received = []
+        self.listener = rl_net.MulticastListener(MULTICAST_GROUP, 0, self.received.append, LOOPBACK)
+        self.addCleanup(self.listener.close)
+
+    def receive(self, sender_id, sequence, color="RED"):
+        return self.listener.receive(memoryview(datagram(sender_id, sequence, ("DISPLAY", color, "HIGH", "STEADY"))))
+
+    def test_duplicates_dropped(self):
+        self.assertTrue(self.receive(1, 10))
+        self.assertFalse(self.receive(1, 10))
+        self.assertFalse(self.receive(1, 10))
+        self.assertEqual(len(self.received), 1)
+        self.assertEqual(self.listener.report()["duplicates"], 2)
+
+    def test_out_of_order_dropped(self):
+        self.assertTrue(self.receive(1, 10, "RED"))
+        self.assertTrue(self.receive(1, 12, "BLUE"))
+        self.assertFalse(self.receive(1, 11, "GREEN"))     # older than BLUE, must not bring GREEN back
+        self.assertEqual([msg[1] for msg in self.received], ["RED", "BLUE"])
+        self.assertEqual(self.listener.report()["lost"], 1)
+
+    def test_senders_independent(self):
+        self.assertTrue(self.receive(1, 10))
+        self.assertTrue(self.receive(2, 3))
+        self.assertTrue(self.receive(1, 11))
+        self.assertFalse(self.receive(2, 3))
+
+    def test_sequence_wraps(self):
+        self.assertTrue(self.receive(1, 0xfffffffe))
+        self.assertTrue(self.receive(1, 0xffffffff))
+        self.assertTrue(self.receive(1, 0))
+        self.assertTrue(self.receive(1, 1))
+        self.assertFalse(self.receive(1, 0xffffffff))      # before the wrap, older
+        self.assertEqual(self.listener.report()["lost"], 0)
+
+    def test_malformed_ignored(self):
+        good = datagram(1, 5, ("DISPLAY", "RED", "HIGH", "STEADY"))
+        self.assertFalse(self.listener.receive(memoryview(good[:5])))
+        self.assertFalse(self.listener.receive(memoryview(b"XX" + good[2:])))
+        self.assertFalse(self.listener.receive(memoryview(good[:-3])))     # truncated payload
+        self.assertTrue(self.receive(1, 5))                 # the bad copies didn't advance the sequence
+        self.assertEqual(self.listener.report()["malformed"], 3)
+
+
+class MulticastLoopbackTest(unittest.TestCase):
+    N_LISTENERS = 3
+
+    def test_every_listener_gets_each_message_once(self):
+        port = 17700
+        received = [[] for k in range(self.N_LISTENERS)]
+        try:
+            listeners = [rl_net.MulticastListener(MULTICAST_GROUP, port, received[k].append, LOOPBACK) for k in range(self.N_LISTENERS)]
+        except OSError as e:
+            self.skipTest("no multicast on loopback: %s" % e)
+        for listener in listeners:
+            self.addCleanup(listener.close)
+            threading.Thread(target=listener.serveForever, daemon=True).start()
+        sender = rl_net.MulticastSender(MULTICAST_GROUP, port, repeat=2, interface=LOOPBACK)
+        self.addCleanup(sender.close)
+
+        colors = ["RED", "GREEN", "BLUE"]
+        for color in colors:
+            sender.send(("DISPLAY", color, "HIGH", "STEADY"))
+        t_end = time.monotonic() + 2.0
+        while any(len(r) < len(colors) for r in received) and time.monotonic() < t_end:
+            time.sleep(0.01)
+        time.sleep(0.05)    # any late repeats
+        for r, listener in zip(received, listeners):
+            self.assertEqual([msg[1] for msg in r], colors)
+            self.assertEqual(listener.report()["duplicates"], 2 * len(colors))
+
+    def test_sender_rejects(self):
+        sender = rl_net.MulticastSender(MULTICAST_GROUP, 17700, interface=LOOPBACK)
+        self.addCleanup(sender.close)
+        self.assertRaises(ValueError, sender.send, ("VI_QUERY",))
+        self.assertRaises(ValueError, sender.send, ("LIGHTING_BATCH", [("3", "N", (1, 2, 3), 1.0)]))
+
+
+class FramingTest(unittest.TestCase):
+    def test_large_frame_grows_buffer(self):
+        a, b = socket.socketpair()
+        self.addCleanup(a.close)
+        self.addCleanup(b.close)
+        sender, receiver = rl_net.FramedConnection(a), rl_net.FramedConnection(b)
+        payload = bytes(range(256)) * 1000     # 256 kB, 4 x RECV_BUFFER
+        small = b"after"
+        t = threading.Thread(target=lambda: (sender.sendFrame(1, 7, payload), sender.sendFrame(2, 8, small)))
+        t.start()
+        msg_type, request_id, encoding, data = receiver.recvFrame()
+        self.assertEqual((msg_type, request_id, len(data)), (1, 7, len(payload)))
+        self.assertEqual(bytes(data), payload)
+        self.assertGreaterEqual(len(receiver.buf), len(payload))
+        self.assertEqual(bytes(receiver.recvFrame()[3]), small)
+        t.join()
+
+    def test_oversized_frame_rejected(self):
+        a, b = socket.socketpair()
+        self.addCleanup(a.close)
+        self.addCleanup(b.close)
+        a.sendall(rl_net.FRAME_HEADER.pack(rl_net.FRAME_MAGIC, rl_net.FRAME_VERSION, rl_net.ENCODING_PICKLE,
+                                           rl_net.MSG_TYPE_IDS["DISPLAY"], 0, 0xffffffff))
+        receiver = rl_net.FramedConnection(b)
+        self.assertRaises(ValueError, receiver.recvFrame)
+        self.assertEqual(len(receiver.buf), receiver.RECV_BUFFER)
+
+    def test_large_message_over_server(self):
+        server = startServer(self, lambda msg, reply: reply(len(msg[1])))
+        client = rl_net.FramedClient(LOOPBACK, server.port)
+        self.addCleanup(client.close)
+        self.assertEqual(client.request(("BIG", b"x" * 300000)), 300000)
+        self.assertEqual(client.request(("SMALL", b"x")), 1)
+
+    def test_split_magic_is_framed(self):
+        received = []
+        server = startServer(self, lambda msg, reply: received.append(msg))
+        payload = pickle.dumps(("DISPLAY", "RED", "HIGH", "STEADY"))
+        frame = rl_net.FRAME_HEADER.pack(rl_net.FRAME_MAGIC, rl_net.FRAME_VERSION, rl_net.ENCODING_PICKLE,
+                                         rl_net.MSG_TYPE_IDS["DISPLAY"], 0, len(payload)) + payload
+        s = socket.create_connection((LOOPBACK, server.port))
+        self.addCleanup(s.close)
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        s.sendall(frame[:1])
+        time.sleep(0.05)
+        s.sendall(frame[1:] + frame)
+        s.shutdown(socket.SHUT_WR)
+        self.assertEqual(s.recv(1), b"")   # server closed after both frames
+        self.assertEqual(received, [("DISPLAY", "RED", "HIGH", "STEADY")] * 2)
+
+    def test_stall_mid_frame_uses_read_timeout(self):
+        server = startServer(self, lambda msg, reply: None, read_timeout=0.2, idle_timeout=30.0)
+        s = socket.create_connection((LOOPBACK, server.port))
+        self.addCleanup(s.close)
+        t_start = time.monotonic()
+        s.sendall(b"RL\x02")
+        self.assertEqual(s.recv(1), b"")   # dropped by the server
+        self.assertLess(time.monotonic() - t_start, 5.0)
+        self.assertEqual(server.report()["timeouts"], 1)
+
+    def test_legacy_pickle_client(self):
+        server = startServer(self, lambda msg, reply: reply(msg[1] * 2))
+        s = socket.create_connection((LOOPBACK, server.port))
+        self.addCleanup(s.close)
+        s.sendall(pickle.dumps(("VI_QUERY", 21)))
+        s.shutdown(socket.SHUT_WR)
+        self.assertEqual(pickle.loads(s.recv(100)), 42)
+
+
+
+class ParkingTest(unittest.TestCase):
+    # idle connections wait in the server's selector, not on a worker
+    def handle(self, msg, reply):
+        if msg[0] == "VI_QUERY":
+            reply((48.0, 250.0))
+
+    def test_idle_connections_hold_no_worker(self):
+        server = startServer(self, self.handle, max_workers=2)
+        idle = [rl_net.FramedClient(LOOPBACK, server.port) for k in range(2)]
+        for client in idle:
+            self.addCleanup(client.close)
+            self.assertEqual(client.request(("VI_QUERY",)), (48.0, 250.0))
+        client = rl_net.FramedClient(LOOPBACK, server.port, timeout=1.0)
+        self.addCleanup(client.close)
+        self.assertEqual(client.request(("VI_QUERY",)), (48.0, 250.0))
+        self.assertEqual(server.report()["open"], 3)
+        for client in idle:     # parked connections are resumed
+            self.assertEqual(client.request(("VI_QUERY",)), (48.0, 250.0))
+
+    def test_idle_timeout(self):
+        server = startServer(self, self.handle, idle_timeout=0.2)
+        client = rl_net.FramedClient(LOOPBACK, server.port)
+        self.addCleanup(client.close)
+        self.assertEqual(client.request(("VI_QUERY",)), (48.0, 250.0))
+        self.assertEqual(client.conn.sock.recv(1), b"")    # closed by the server
+        self.assertEqual(server.report()["idle_closed"], 1)
+
+    def test_silent_client_times_out(self):
+        server = startServer(self, self.handle, read_timeout=0.2)
+        server.log.disabled = True
+        self.addCleanup(setattr, server.log, "disabled", False)
+        s = socket.create_connection((LOOPBACK, server.port))
+        self.addCleanup(s.close)
+        self.assertEqual(s.recv(1), b"")
+        self.assertEqual(server.report()["timeouts"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()